@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+# This program is licenced under an MIT license. Full licence is at the end of
+# this file.
+"""
+Animations.py
+Frame calculations for the time-dependent animations in Orbitals_UI. Nothing
+in here depends on Qt or Mayavi, so the same frames can be produced by the
+GUI or by scripts.
+
+Every animation is a superposition psi(t) = sum_k w_k(t) exp(i bohr_k t) A_k
+where A_k is the angular part of orbital k on a fixed grid. The A_k only
+change when a new orbital is selected, so they are evaluated once and each
+frame is a small linear combination.
+
+@author: Matthew B Rowley
+"""
+from __future__ import division
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import contextlib
+import copy
+import queue
+import threading
+import time
+import numpy as np
+
+
+class SuperpositionKernel(object):
+    '''
+    Caches the angular amplitudes of a set of orbitals on a grid and builds
+    animation frames from them. weights(t) returns one real weight per
+    orbital and radius(t) the radius of the surface at time t. Frames are
+    computed in the grid's precision.
+    '''
+    def __init__(self, grid, orbitals, weights, radius):
+        self.grid = grid
+        self.orbitals = orbitals
+        self.weights = weights
+        self.radius = radius
+        self.bohrs = np.array([orbital.bohr for orbital in orbitals], float)
+        self.dtype = np.result_type(grid.cos_phi)
+        self.complex = np.result_type(self.dtype, np.complex64)
+        self.amplitudes = [np.asarray(orbital.angular(grid), self.complex)
+                           for orbital in orbitals]
+        self.allocate()
+
+    def allocate(self):
+        '''Allocate the output buffers'''
+        shape = np.shape(self.grid.theta)
+        self.psi = np.empty(shape, self.complex)
+        self.scratch = np.empty(shape, self.complex)
+        self.density = np.empty(shape, self.dtype)
+        self.x = np.empty(shape, self.dtype)
+        self.y = np.empty(shape, self.dtype)
+        self.z = np.empty(shape, self.dtype)
+        self.phase = np.empty(shape, self.dtype)
+
+    def copy(self):
+        '''
+        Return a kernel which shares these amplitudes but has its own output
+        buffers, so that it can be used from another thread.
+        '''
+        kernel = copy.copy(self)
+        kernel.allocate()
+        return kernel
+
+    def coefficients(self, t):
+        '''Return the complex coefficient of each amplitude at time t'''
+        return np.asarray(self.weights(t)) * np.exp(1j * self.bohrs * t)
+
+    def evaluate(self, t):
+        '''Write psi(t) into the psi buffer and return it'''
+        coefficients = self.coefficients(t).astype(self.complex)
+        np.multiply(self.amplitudes[0], coefficients[0], out=self.psi)
+        for coefficient, amplitude in zip(coefficients[1:], self.amplitudes[1:]):
+            np.multiply(amplitude, coefficient, out=self.scratch)
+            self.psi += self.scratch
+        return self.psi
+
+    def frame(self, t):
+        '''
+        Return (x, y, z, phase) for time t: the grid's unit sphere scaled by
+        radius(t) and by the density in each direction, and the phase of psi.
+        The arrays are the kernel's own buffers, so they are overwritten by
+        the next call.
+        '''
+        psi = self.evaluate(t)
+        np.absolute(psi, out=self.density)
+        self.density *= self.density
+        self.density *= self.radius(t)
+        np.multiply(self.density, self.grid.x, out=self.x)
+        np.multiply(self.density, self.grid.y, out=self.y)
+        np.multiply(self.density, self.grid.z, out=self.z)
+        np.arctan2(psi.imag, psi.real, out=self.phase)
+        return self.x, self.y, self.z, self.phase
+
+
+class FrameCache(object):
+    '''
+    A float32 ring buffer of precomputed frames for a periodic animation.
+    Frame f is the kernel evaluated at times[f % len(times)]. A background
+    thread fills the frames ahead of the playhead, so playback can start
+    right away and just reads frames once they are ready.
+
+    If the whole cycle fits in max_bytes every frame is kept and, once
+    filled, playback never computes anything again. Otherwise the buffer
+    holds a window of frames ahead of the playhead, which is refilled as
+    the playhead advances.
+    '''
+    def __init__(self, kernel, times, max_bytes=128 * 2**20):
+        self.kernel = kernel.copy()
+        self.times = times
+        shape = np.shape(kernel.grid.theta)
+        frame_bytes = 4 * 4 * int(np.prod(shape))
+        self.capacity = int(max(1, min(len(times), max_bytes // frame_bytes)))
+        self.frames = np.empty((self.capacity, 4) + shape, np.float32)
+        # The index into times held by each slot, -1 for empty slots
+        self.stored = np.full(self.capacity, -1)
+        self.playhead = 0
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.fill)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def nextMissing(self):
+        '''Return the first frame in the window which isn't stored yet'''
+        frames = self.playhead + np.arange(self.capacity)
+        missing = self.stored[frames % self.capacity] != frames % len(self.times)
+        if not missing.any():
+            return None
+        return frames[np.argmax(missing)]
+
+    def fill(self):
+        '''Worker loop: compute missing frames, then wait for the playhead'''
+        while True:
+            with self.condition:
+                frame = self.nextMissing()
+                while self.running and frame is None:
+                    self.condition.wait()
+                    frame = self.nextMissing()
+                if not self.running:
+                    return
+            index = frame % len(self.times)
+            slot = frame % self.capacity
+            data = self.kernel.frame(self.times[index])
+            with self.condition:
+                for array, values in zip(self.frames[slot], data):
+                    array[...] = values
+                self.stored[slot] = index
+
+    def get(self, frame):
+        '''
+        Move the playhead to this frame and return its (x, y, z, phase)
+        arrays, or None if the worker hasn't reached it yet.
+        '''
+        slot = frame % self.capacity
+        with self.condition:
+            if frame != self.playhead:
+                self.playhead = frame
+                self.condition.notify()
+            if self.stored[slot] == frame % len(self.times):
+                return tuple(self.frames[slot])
+        return None
+
+    def progress(self):
+        '''Return the fraction of the buffer which holds frames'''
+        return np.count_nonzero(self.stored >= 0) / self.capacity
+
+    def stop(self):
+        '''Stop the worker thread'''
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+
+class FrameStore(object):
+    '''
+    A triple buffer for handing frames from the calculator to the
+    visualization. A frame is a tuple of arrays or scalars, e.g.
+    (x, y, z, phase) or (bond_length, Low, High), which is copied into
+    preallocated float32 buffers, so nothing is allocated per frame once the
+    shapes are known.
+
+    The writer fills the back buffer and publishes it by swapping it with
+    the middle one, so a frame which is never read is simply replaced by
+    the next. The reader swaps the middle buffer to the front when it holds
+    a newer generation. Only these index swaps hold the lock, never the
+    copies, so the reader always sees a complete frame and the writer never
+    waits on rendering. Writes from different threads take turns.
+    '''
+    def __init__(self):
+        self.buffers = [None, None, None]
+        self.generations = [0, 0, 0]
+        self.back, self.middle, self.front = 0, 1, 2
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.writing = threading.Lock()
+
+    def write(self, frame):
+        '''
+        Copy a frame into the back buffer and publish it, returning its
+        generation
+        '''
+        with self.writing:
+            buffer = self.buffers[self.back]
+            if not fits(buffer, frame):
+                buffer = self.buffers[self.back] = allocate_like(frame)
+            for array, values in zip(buffer, frame):
+                array[...] = values
+            with self.lock:
+                self.generation += 1
+                self.generations[self.back] = self.generation
+                self.back, self.middle = self.middle, self.back
+                return self.generation
+
+    def read(self):
+        '''
+        Return (generation, frame) for the newest published frame. The arrays
+        stay untouched until the next read. Returns (0, None) before anything
+        has been written.
+        '''
+        with self.lock:
+            if self.generations[self.middle] > self.generations[self.front]:
+                self.front, self.middle = self.middle, self.front
+            buffer = self.buffers[self.front]
+            generation = self.generations[self.front]
+        if buffer is None:
+            return 0, None
+        return generation, tuple(array if array.ndim else array[()]
+                                 for array in buffer)
+
+
+class FramePacer(object):
+    '''
+    Keeps an animation on time. The frame due at any moment follows from the
+    wall clock, so when computing and rendering a frame takes longer than
+    the interval (in seconds) the animation skips frames instead of slowing
+    down. Frames put on screen are reported with shown, and the time spent
+    on each frame in a stage such as 'compute' or 'render' with measure or
+    record. stats summarises the most recent window of frames.
+    '''
+    def __init__(self, interval=0.04, window=50, clock=time.perf_counter):
+        self.interval = interval
+        self.window = window
+        self.clock = clock
+        # Compute times are recorded from worker threads
+        self.lock = threading.Lock()
+        self.start()
+        self.origin = None  # Not running until start is called
+
+    def start(self, frame=0):
+        '''Start the clock with this frame due now, clearing the statistics'''
+        with self.lock:
+            self.origin = self.clock()
+            self.first = frame
+            self.last = None
+            self.dropped = 0
+            self.shown_at = collections.deque(maxlen=self.window)
+            self.latencies = collections.deque(maxlen=self.window)
+            self.timings = {}
+
+    def due(self):
+        '''Return the frame which should be on screen now'''
+        if self.origin is None:
+            return self.first
+        return self.first + int((self.clock() - self.origin) / self.interval)
+
+    def until(self, frame):
+        '''Return the seconds until a frame is due, negative once it is'''
+        if self.origin is None:
+            return 0.0
+        return self.origin + (frame - self.first) * self.interval - self.clock()
+
+    def shown(self, frame):
+        '''
+        Record that a frame is now on screen, counting any frames skipped
+        since the last one as dropped
+        '''
+        now = self.clock()
+        with self.lock:
+            if self.last is not None and frame > self.last + 1:
+                self.dropped += frame - self.last - 1
+            self.last = frame
+            self.shown_at.append(now)
+            if self.origin is not None:
+                due = self.origin + (frame - self.first) * self.interval
+                self.latencies.append(now - due)
+
+    def record(self, stage, seconds):
+        '''Record the time one frame spent in a stage'''
+        with self.lock:
+            if stage not in self.timings:
+                self.timings[stage] = collections.deque(maxlen=self.window)
+            self.timings[stage].append(seconds)
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        '''Record the time spent in a with block as one frame of a stage'''
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(stage, self.clock() - start)
+
+    def stats(self):
+        '''
+        Return a dict of the frames per second, the frames dropped since the
+        clock started, and the mean latency (how late frames reach the
+        screen) and time per stage in seconds over the recent window
+        '''
+        with self.lock:
+            shown_at = list(self.shown_at)
+            fps = 0.0
+            if len(shown_at) > 1 and shown_at[-1] > shown_at[0]:
+                fps = (len(shown_at) - 1) / (shown_at[-1] - shown_at[0])
+            stats = {'fps': fps, 'dropped': self.dropped,
+                     'latency': mean(self.latencies)}
+            for stage, times in self.timings.items():
+                stats[stage] = mean(times)
+        return stats
+
+    def summary(self):
+        '''The stats as a line of text'''
+        stats = self.stats()
+        text = '{:.1f} fps, {} dropped, {:.0f} ms late'.format(
+            stats.pop('fps'), stats.pop('dropped'),
+            1000 * stats.pop('latency'))
+        for stage in sorted(stats):
+            text += ', {} {:.0f} ms'.format(stage, 1000 * stats[stage])
+        return text
+
+
+def mean(values):
+    '''The mean of a sequence, or 0 if it is empty'''
+    return sum(values) / len(values) if len(values) else 0.0
+
+
+def fits(buffer, frame):
+    '''Whether a buffer from allocate_like can hold this frame'''
+    return (buffer is not None and len(buffer) == len(frame) and
+            all(array.shape == np.shape(values)
+                for array, values in zip(buffer, frame)))
+
+
+def allocate_like(frame):
+    '''Allocate float32 arrays matching the shapes in a frame'''
+    return tuple(np.empty(np.shape(values), np.float32) for values in frame)
+
+
+def precompute(kernel, times, workers=2, depth=16):
+    '''
+    Yield a float32 (x, y, z, phase) frame for each of the times in order.
+    Frames are computed ahead on worker threads, each with its own copy of
+    the kernel, with at most depth frames in flight. Every frame is a fresh
+    copy which the caller may keep.
+    '''
+    kernels = queue.Queue()
+    for _ in range(workers):
+        kernels.put(kernel.copy())
+
+    def compute(t):
+        own = kernels.get()
+        try:
+            return allocate_copy(own.frame(t))
+        finally:
+            kernels.put(own)
+
+    with ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        for t in times:
+            pending.append(executor.submit(compute, t))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def allocate_copy(frame):
+    '''Return a float32 copy of a frame'''
+    return tuple(np.array(values, np.float32) for values in frame)
+
+
+def stationary_kernel(grid, orbital):
+    '''A single orbital, which only changes phase in time'''
+    radius = orbital.r_90p
+    return SuperpositionKernel(grid, [orbital], lambda t: (1,),
+                               lambda t: radius)
+
+
+def coherence_kernel(grid, ket, bra):
+    '''An equal superposition of the ket and bra'''
+    radius = 0.5 * (ket.r_90p + bra.r_90p)
+    weight = 0.5 * np.sqrt(2)
+    return SuperpositionKernel(grid, [ket, bra], lambda t: (weight, weight),
+                               lambda t: radius)
+
+
+def rabi_kernel(grid, ket, bra):
+    '''Population cycling between the bra (at t=0) and the ket'''
+    ket_radius, bra_radius = ket.r_90p, bra.r_90p
+    return SuperpositionKernel(
+        grid, [ket, bra], lambda t: (np.sin(t), np.cos(t)),
+        lambda t: (np.sin(t) * np.sin(t) * ket_radius +
+                   np.cos(t) * np.cos(t) * bra_radius))
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Matthew B. Rowley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# This program is licenced under an MIT license. Full licence is at the end of
+# this file.
+"""
+Export_Animation.py
+Export the animations of the Orbitals application to a video or to numbered
+PNG images, rendered offscreen. The animation clock steps through one cycle
+frame by frame, so the export is identical from run to run and takes as
+long as the frames take to compute and render rather than the time they
+take to play. Examples:
+
+    python Export_Animation.py stationary 3dxy --output 3dxy.webm
+    python Export_Animation.py rabi 2pz 3dxy --frames 1000 --output rabi.mp4
+    python Export_Animation.py coherence 1s 2pz --output frames/{:04d}.png
+
+The bohr frequencies default to those of the application (10 for the ket,
+50 for the bra) and can be changed with --bohr.
+
+Videos are encoded by ffmpeg, which must be on the path.
+
+@author: Matthew B Rowley
+"""
+from __future__ import division
+import argparse
+import sys
+import time
+import numpy as np
+import Animations
+import Grids
+import Hydrogenic as hyd
+
+kernels = {'stationary': Animations.stationary_kernel,
+           'coherence': Animations.coherence_kernel,
+           'rabi': Animations.rabi_kernel}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Render an orbital animation offscreen")
+    parser.add_argument('kind', choices=sorted(kernels),
+                        help="the animation, as in the Orbitals application")
+    parser.add_argument('orbitals', nargs='+',
+                        help="one orbital for stationary, else ket and bra")
+    parser.add_argument('--output', required=True,
+                        help="a video, or a pattern like frames/{:04d}.png")
+    parser.add_argument('--bohr', type=float, nargs='+',
+                        help="bohr frequency of each orbital (default as in "
+                             "the application: 1, or 10 for the ket and 50 "
+                             "for the bra)")
+    parser.add_argument('--frames', type=int,
+                        help="frames per cycle (default 100 for stationary "
+                             "states, else 1000)")
+    parser.add_argument('--fps', type=int, default=25)
+    parser.add_argument('--size', type=int, nargs=2, default=[800, 800])
+    parser.add_argument('--resolution', type=int, default=50,
+                        help="polar points on the surface mesh (default 50)")
+    parser.add_argument('--workers', type=int, default=2,
+                        help="threads computing frames ahead (default 2)")
+    args = parser.parse_args(argv)
+    expected = 1 if args.kind == 'stationary' else 2
+    if len(args.orbitals) != expected:
+        parser.error("{} takes {} orbital(s)".format(args.kind, expected))
+    bohrs = args.bohr or ([1] if args.kind == 'stationary' else [10, 50])
+    if len(bohrs) != expected:
+        parser.error("give one --bohr value per orbital")
+    # Copies, so the shared registry orbitals keep their own bohr values
+    orbitals = [hyd.orbitals[name].withBohr(bohr)
+                for name, bohr in zip(args.orbitals, bohrs)]
+    grid = Grids.get_spherical_grid(args.resolution, 2*args.resolution)
+    kernel = kernels[args.kind](grid, *orbitals)
+    frames = args.frames or (100 if args.kind == 'stationary' else 1000)
+    # One period, without repeating the first frame at the end
+    times = np.linspace(0, 2*np.pi, frames, endpoint=False)
+    import Renderers
+    start = time.time()
+    count = Renderers.export_animation(kernel, times, args.output, args.fps,
+                                       args.size, workers=args.workers)
+    seconds = time.time() - start
+    print("{} frames in {:.1f} s ({:.1f} s of playback)".format(
+        count, seconds, count / args.fps))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Matthew B. Rowley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
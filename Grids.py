@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+# This program is licenced under an MIT license. Full licence is at the end of
+# this file.
+"""
+Grids.py
+Evaluation grids for hydrogenic wavefunctions. A grid computes its
+spherical coordinates and trigonometric basis once, and caches the most
+recently used tables derived from them (phase factors, Legendre
+functions), up to table_bytes per grid, so that repeated evaluations on
+the same grid only pay for a few multiplies.
+
+The angular and radial functions from Hydrogenic accept a grid in place of
+their usual coordinate arguments, i.e. orbital.angular(grid) and
+orbital.radial(grid).
+
+Coordinates follow the convention in Hydrogenic: theta is the azimuthal
+angle in the xy plane and phi is the angle with the z axis.
+
+Cartesian grids for the render scripts can be saved as .npy files in
+cache_directory (set ORBITALS_CACHE to move it), so that later runs memory
+map the coordinates instead of recomputing them.
+
+Grids compute in float64 by default. Set ORBITALS_PRECISION=float32 or call
+set_precision to halve the memory and bandwidth of everything evaluated on
+the shared grids.
+
+@author: Matthew B Rowley
+"""
+from __future__ import division
+from collections import OrderedDict
+from functools import lru_cache
+import os
+from threading import Lock
+import numpy as np
+
+cache_directory = os.environ.get(
+    'ORBITALS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'Orbitals'))
+
+# The dtype of the shared grids, see set_precision
+precision = np.dtype(os.environ.get('ORBITALS_PRECISION', 'float64'))
+
+# The memory each grid may hold in derived tables, see Grid.table
+table_bytes = 128 * 2**20
+
+
+class Grid(object):
+    '''
+    Base class for evaluation grids. Subclasses set r, theta, phi, cos_phi,
+    sin_phi, cos_theta and sin_theta. Every array handed out is read-only
+    because grids are shared between callers.
+    '''
+    def __init__(self):
+        self.cache = {}
+        self.tables = OrderedDict()
+        self.table_nbytes = 0
+        self.lock = Lock()
+
+    def memo(self, key, factory):
+        '''Return cache[key], calling factory() to fill it the first time'''
+        try:
+            return self.cache[key]
+        except KeyError:
+            value = self.cache[key] = readonly(factory())
+            return value
+
+    def table(self, key, factory):
+        '''
+        Return a table derived from the coordinates, calling factory() to
+        build it if it isn't held. Unlike the coordinates themselves, tables
+        are only held up to table_bytes in total, dropping the least
+        recently used first, and a table larger than that isn't held at all.
+        '''
+        with self.lock:
+            if key in self.tables:
+                self.tables.move_to_end(key)
+                return self.tables[key]
+        value = readonly(factory())
+        if value.nbytes > table_bytes:
+            return value
+        with self.lock:
+            if key not in self.tables:
+                self.tables[key] = value
+                self.table_nbytes += value.nbytes
+            while self.table_nbytes > table_bytes:
+                self.table_nbytes -= self.tables.popitem(last=False)[1].nbytes
+            return self.tables[key]
+
+    def phase(self, m):
+        '''Return exp(1j*m*theta), cached per m'''
+        if m == 0:
+            return self.table(('phase', 0), lambda: np.ones(
+                np.shape(self.theta), np.result_type(self.cos_theta,
+                                                     np.complex64)))
+        if m < 0:
+            return self.table(('phase', m), lambda: np.conj(self.phase(-m)))
+        return self.table(('phase', m), lambda: (self.cos_theta +
+                                                1j*self.sin_theta)**m)
+
+
+class SphericalGrid(Grid):
+    '''
+    A phi x theta mesh over a sphere of radius r, as used by the animations
+    in Orbitals_UI. x, y and z are the unit sphere coordinates. Every array
+    has the given dtype, and so does anything evaluated on the grid.
+    '''
+    def __init__(self, n_phi=50, n_theta=100, r=1, dtype=np.float64):
+        Grid.__init__(self)
+        self.shape = (n_phi, n_theta)
+        self.dtype = np.dtype(dtype)
+        self.r = r
+        phi, theta = np.mgrid[0:np.pi:n_phi*1j, 0:2*np.pi:n_theta*1j]
+        phi, theta = phi.astype(self.dtype), theta.astype(self.dtype)
+        self.phi = readonly(phi)
+        self.theta = readonly(theta)
+        self.cos_phi = readonly(np.cos(phi))
+        self.sin_phi = readonly(np.sin(phi))
+        self.cos_theta = readonly(np.cos(theta))
+        self.sin_theta = readonly(np.sin(theta))
+        self.x = readonly(self.sin_phi*self.cos_theta)
+        self.y = readonly(self.sin_phi*self.sin_theta)
+        self.z = self.cos_phi
+
+
+def cartesian_field(name):
+    '''A CartesianGrid attribute which is loaded or computed on first use'''
+    return property(lambda self: self.field(name))
+
+
+class CartesianGrid(Grid):
+    '''
+    A box of points like np.mgrid[-20:20:150j, -20:20:150j, -20:20:150j], as
+    used by the render scripts. extent is a half width or three (low, high)
+    pairs and resolution a point count or one per axis.
+
+    x, y and z are broadcast views of the 1D axes, so they take no memory.
+    The spherical coordinates and trig basis are computed on first use, with
+    theta from arctan2 so every quadrant is right and the origin taken as
+    r = 0, phi = theta = 0 rather than dividing by zero. Given a directory
+    they are saved there and memory mapped by later grids.
+
+    Alternatively pass the three 1D axes themselves as axes.
+    '''
+    def __init__(self, extent=20, resolution=150, dtype=np.float64,
+                 directory=None, axes=None):
+        Grid.__init__(self)
+        self.dtype = np.dtype(dtype)
+        self.directory = directory
+        if axes is None:
+            extent = box_extent(extent)
+            resolution = box_resolution(resolution)
+            axes = tuple(box_axis(low, high, n, self.dtype)
+                         for (low, high), n in zip(extent, resolution))
+        self.axes = tuple(readonly(np.asarray(axis, self.dtype))
+                          for axis in axes)
+        self.extent = tuple((float(axis[0]), float(axis[-1]))
+                            for axis in self.axes)
+        self.shape = tuple(len(axis) for axis in self.axes)
+        x, y, z = self.axes
+        self.x = np.broadcast_to(x[:, None, None], self.shape)
+        self.y = np.broadcast_to(y[None, :, None], self.shape)
+        self.z = np.broadcast_to(z[None, None, :], self.shape)
+
+    r = cartesian_field('r')
+    rho = cartesian_field('rho')
+    theta = cartesian_field('theta')
+    phi = cartesian_field('phi')
+    cos_phi = cartesian_field('cos_phi')
+    sin_phi = cartesian_field('sin_phi')
+    cos_theta = cartesian_field('cos_theta')
+    sin_theta = cartesian_field('sin_theta')
+
+    def slab(self, start, stop):
+        '''
+        Return a CartesianGrid over the x planes start:stop of this one,
+        which is a contiguous block of any array on this grid. It is never
+        saved to disk.
+        '''
+        x, y, z = self.axes
+        return CartesianGrid(dtype=self.dtype, axes=(x[start:stop], y, z))
+
+    def meridian(self):
+        '''
+        Return (grid, rho_index, z_index, z_flip) where grid is the
+        MeridianGrid over the distinct rho and |z| values of this grid. A
+        function f of (rho, |z|) tabulated on it is expanded to this grid by
+        f[:, z_index][rho_index], and z_flip marks the points below z = 0.
+        '''
+        return self.memo('meridian', self.buildMeridian)
+
+    def buildMeridian(self):
+        '''Build the tuple returned by meridian'''
+        x, y, z = self.axes
+        rho = np.hypot(x[:, None], y[None, :])
+        rho_values, rho_index = np.unique(rho, return_inverse=True)
+        z_values, z_index = np.unique(np.abs(z), return_inverse=True)
+        return (MeridianGrid(rho_values, z_values),
+                readonly(rho_index.reshape(rho.shape)), readonly(z_index),
+                readonly(z < 0))
+
+    def azimuth(self):
+        '''Return the AzimuthGrid over this grid's x and y axes'''
+        return self.memo('azimuth', lambda: AzimuthGrid(*self.axes[:2]))
+
+    def name(self):
+        '''A file name prefix which identifies this grid'''
+        bounds = '_'.join('%g_%g' % pair for pair in self.extent)
+        return 'cartesian_%s_%s_%s' % (self.dtype.name,
+                                       'x'.join(map(str, self.shape)), bounds)
+
+    def field(self, name):
+        '''Return a coordinate array, from memory, disk or computed'''
+        return self.memo(name, lambda: self.restore(name))
+
+    def restore(self, name):
+        '''Load a field from the directory, computing and saving it if needed'''
+        if self.directory is None:
+            return self.compute(name)
+        path = os.path.join(self.directory, '%s_%s.npy' % (self.name(), name))
+        try:
+            return np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            pass
+        array = self.compute(name)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write under a temporary name so other processes never load a
+            # partial file
+            temporary = '%s.%d.tmp' % (path, os.getpid())
+            with open(temporary, 'wb') as f:
+                np.save(f, array)
+            os.replace(temporary, path)
+            return np.load(path, mmap_mode='r')
+        except OSError:
+            return array
+
+    def compute(self, name):
+        '''Compute one of the coordinate arrays'''
+        x, y, z = self.x, self.y, self.z
+        if name == 'rho':
+            return np.hypot(x, y)
+        if name == 'r':
+            return np.hypot(self.rho, z)
+        if name == 'theta':
+            return np.arctan2(y, x)
+        if name == 'phi':
+            return np.arctan2(self.rho, z)
+        if name in ('cos_phi', 'sin_phi'):
+            numerator, default = (z, 1) if name == 'cos_phi' else (self.rho, 0)
+            denominator = self.r
+        elif name in ('cos_theta', 'sin_theta'):
+            numerator, default = (x, 1) if name == 'cos_theta' else (y, 0)
+            denominator = self.rho
+        else:
+            raise KeyError(name)
+        return safe_divide(numerator, denominator, default)
+
+
+class MeridianGrid(Grid):
+    '''
+    The half plane theta = 0 (y = 0, x = rho >= 0) at the given rho and z
+    values, with shape (len(rho), len(z)). Anything with axial symmetry only
+    needs evaluating here.
+    '''
+    def __init__(self, rho, z):
+        Grid.__init__(self)
+        self.shape = (len(rho), len(z))
+        rho, z = np.broadcast_arrays(rho[:, None], z[None, :])
+        self.rho = readonly(rho)
+        self.z = readonly(z)
+        self.r = readonly(np.hypot(rho, z))
+        self.phi = readonly(np.arctan2(rho, z))
+        self.theta = readonly(np.zeros(self.shape, rho.dtype))
+        self.cos_phi = readonly(safe_divide(z, self.r, 1))
+        self.sin_phi = readonly(safe_divide(rho, self.r, 0))
+        self.cos_theta = readonly(np.ones(self.shape, rho.dtype))
+        self.sin_theta = self.theta
+
+
+class AzimuthGrid(Grid):
+    '''
+    The x by y plane of a CartesianGrid, for the factors of a wavefunction
+    which only depend on theta
+    '''
+    def __init__(self, x, y):
+        Grid.__init__(self)
+        self.shape = (len(x), len(y))
+        x, y = np.broadcast_arrays(x[:, None], y[None, :])
+        self.rho = readonly(np.hypot(x, y))
+        self.theta = readonly(np.arctan2(y, x))
+        self.cos_theta = readonly(safe_divide(x, self.rho, 1))
+        self.sin_theta = readonly(safe_divide(y, self.rho, 0))
+
+
+def set_precision(dtype):
+    '''
+    Set the dtype of the shared grids handed out from now on, np.float32 or
+    np.float64. Everything evaluated on a grid follows its dtype, so float32
+    grids give float32 and complex64 wavefunctions.
+    '''
+    global precision
+    precision = np.dtype(dtype)
+
+
+def get_spherical_grid(n_phi=50, n_theta=100, dtype=None):
+    '''
+    Return the shared unit SphericalGrid for this resolution and dtype,
+    which defaults to precision
+    '''
+    return shared_spherical_grid(n_phi, n_theta,
+                                 np.dtype(dtype or precision).name)
+
+
+@lru_cache(maxsize=8)
+def shared_spherical_grid(n_phi, n_theta, dtype):
+    '''The cache behind get_spherical_grid'''
+    return SphericalGrid(n_phi, n_theta, dtype=dtype)
+
+
+def get_cartesian_grid(extent=20, resolution=150, dtype=None):
+    '''
+    Return the shared CartesianGrid for this extent, resolution and dtype
+    (by default precision), which keeps its coordinates in cache_directory
+    between runs
+    '''
+    return shared_cartesian_grid(box_extent(extent), box_resolution(resolution),
+                                 np.dtype(dtype or precision).name)
+
+
+@lru_cache(maxsize=8)
+def shared_cartesian_grid(extent, resolution, dtype):
+    '''The cache behind get_cartesian_grid, keyed on normalized arguments'''
+    return CartesianGrid(extent, resolution, dtype, cache_directory)
+
+
+def safe_divide(numerator, denominator, default):
+    '''numerator/denominator, or default wherever the denominator is zero'''
+    numerator, denominator = np.broadcast_arrays(numerator, denominator)
+    out = np.full(numerator.shape, default, np.result_type(numerator,
+                                                           denominator))
+    return np.divide(numerator, denominator, out=out, where=denominator > 0)
+
+
+def box_axis(low, high, n, dtype):
+    '''
+    Return np.linspace(low, high, n), made exactly symmetric when the axis
+    is centred on zero so that mirrored points have identical coordinates
+    '''
+    axis = np.linspace(low, high, n)
+    if low == -high:
+        axis = 0.5*(axis - axis[::-1])
+    return axis.astype(dtype)
+
+
+def box_extent(extent):
+    '''Normalize a half width or three (low, high) pairs to a tuple of pairs'''
+    if np.ndim(extent) == 0:
+        return ((-float(extent), float(extent)),) * 3
+    return tuple((float(low), float(high)) for low, high in extent)
+
+
+def box_resolution(resolution):
+    '''Normalize a point count or one count per axis to a tuple of three'''
+    if np.ndim(resolution) == 0:
+        return (int(resolution),) * 3
+    return tuple(int(n) for n in resolution)
+
+
+def readonly(array):
+    '''Mark an array as read-only and return it'''
+    if isinstance(array, np.ndarray):
+        array.setflags(write=False)
+    return array
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Matthew B. Rowley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
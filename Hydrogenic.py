@@ -17,9 +17,16 @@ takes values from 0 to pi.
 @author: Matthew B Rowley
 """
 from __future__ import division
-from scipy.special import sph_harm as sh
+from collections import OrderedDict
+from collections.abc import Mapping
+import copy
+from functools import lru_cache
+from math import lgamma, log, sqrt
+import numbers
+from threading import Lock
 import numpy as np
-from numpy import cos, sin, sqrt, pi, exp
+from numpy import cos, sin, pi, exp
+import Grids
 
 sqrt2 = sqrt(2)
 sqrt3 = sqrt(3)
@@ -91,22 +98,35 @@ p_dict = {'x': lambda theta, phi: sqrt3/sqrtpi/2*sin(phi)*cos(theta),
           -1: lambda theta, phi: sqrt3/sqrt2/sqrtpi/2*exp(-1j*theta)*sin(phi)
           }
 
-# TODO: 4x dont have z dependence and 5x are totally wrong
+# The real orbitals above as combinations of the complex harmonics,
+# name: (m, a, b) for a*Y(l, m) + b*Y(l, -m)
+real_combinations = {1: {'x': (1, -1/sqrt2, 1/sqrt2),
+                         'y': (1, 1j/sqrt2, 1j/sqrt2),
+                         'z': (0, 1, 0)},
+                     2: {'z^2': (0, 1, 0),
+                         'xz': (1, -1/sqrt2, 1/sqrt2),
+                         'yz': (1, 1j/sqrt2, 1j/sqrt2),
+                         'x^2-y^2': (2, 1/sqrt2, 1/sqrt2),
+                         'xy': (2, -1j/sqrt2, 1j/sqrt2)},
+                     3: {'z^3': (0, 1, 0),
+                         'xz^2': (1, -1j/sqrt2, -1j/sqrt2),
+                         'yz^2': (1, 1/sqrt2, -1/sqrt2),
+                         'xyz': (2, 1/sqrt2, 1/sqrt2),
+                         'z(x^2-y^2)': (2, -1j/sqrt2, 1j/sqrt2),
+                         'x(x^2-3y^2)': (3, -1j/sqrt2, -1j/sqrt2),
+                         'y(3x^3-y^2)': (3, 1/sqrt2, -1/sqrt2)}
+                     }
+
+l_numbers = {'s': 0, 'p': 1, 'd': 2, 'f': 3, 'g': 4}
+
+# Hand-written radial functions for the lowest shells. Everything else is
+# generated by the generalized Laguerre engine in get_radial.
 radials = {'10': lambda r, z: 2*z**(3/2)*np.exp(-z*r),
            '20': lambda r, z: 2*(z/2)**(3/2)*(1-z*r/2)*np.exp(-z*r/2),
            '21': lambda r, z: 1/sqrt3*(z/2)**(3/2)*z*r*np.exp(-z*r/2),
            '30': lambda r, z: 2*(z/3)**(3/2)*(1-2*z*r/3+2*z*z*r*r/27)*np.exp(-z*r/3),
            '31': lambda r, z: 8/27/sqrt6*z**(3/2)*(z*r-z*z*r*r/6)*np.exp(-z*r/3),
-           '32': lambda r, z: 4/81/sqrt30*z**(7/2)*r*r*np.exp(-z*r/3),
-           '40': lambda r, z: 1/4*(1-3*r/4+r*r/8-r*r*r/192)*np.exp(-r/4),
-           '41': lambda r, z: sqrt5/16/sqrt3*(1-r/4+r*r/80)*r*np.exp(-r/4),
-           '42': lambda r, z: r*r/64/sqrt5*(1-r/12)*np.exp(-r/4),
-           '43': lambda r, z: r*r*r/768/sqrt35*np.exp(-r/4),
-           '50': lambda r, z: 2,
-           '51': lambda r, z: 2,
-           '52': lambda r, z: 2,
-           '53': lambda r, z: 2,
-           '54': lambda r, z: 2
+           '32': lambda r, z: 4/81/sqrt30*z**(7/2)*r*r*np.exp(-z*r/3)
            }
 
 
@@ -124,24 +144,263 @@ class Orbital:
         self.s = s
         self.z = z
         self.m = m
+        self.real = is_real(self.l, self.m)
         self.angular = get_angular(self.l, self.m, self.s)
         self.radial = get_radial(self.n, self.l, self.z)
-        self.r_90p = get_90p(self.radial)
+        self._r_90p = None
         self.psi = lambda r, theta, phi: (self.radial(r) *
                                           self.angular(theta, phi))
         self.bohr = bohr
 
+    @property
+    def r_90p(self):
+        '''The radius enclosing 90% of the density, found on first access'''
+        if self._r_90p is None:
+            self._r_90p = get_90p(self.radial)
+        return self._r_90p
+
+    def evaluate(self, grid, density=False, symmetric=True, dtype=None):
+        '''
+        Return psi, or the density |psi|^2, on a Grids.Grid.
+
+        On a Grids.CartesianGrid the orbital's symmetry is used to cut the
+        work. Every hydrogenic orbital is R(r)*P(cos(phi)), which only
+        depends on rho and |z| (up to a sign of (-1)**(l+|m|) below the xy
+        plane), times a function of theta, which only depends on x and y.
+        Each factor is evaluated on its own small grid and the full grid is
+        filled by indexing, so for a cube of side N only about N**3/16
+        points are evaluated. Set symmetric=False to evaluate every point.
+
+        Real orbitals (see is_real) give real arrays, and dtype (e.g.
+        np.float32) sets the precision of the full sized result.
+        '''
+        if not (symmetric and isinstance(grid, Grids.CartesianGrid)):
+            psi = with_precision(self.radial(grid) * self.angular(grid),
+                                 dtype)
+            if not density:
+                return psi
+            return psi*psi if self.real else (np.conj(psi)*psi).real
+        meridian, rho_index, z_index, z_flip = grid.meridian()
+        l = l_numbers.get(self.l, self.l)
+        am, coefficient, part = angular_parts(l, self.m, self.s)
+        # R(r)*P(cos(phi)) on the distinct (rho, |z|), mirrored onto every z
+        table = (coefficient*self.radial(meridian) *
+                 legendre_on_grid(l, am, meridian))[:, z_index]
+        if (l + am) % 2:
+            table[:, z_flip] *= -1
+        table = with_precision(table, dtype)
+        if density:
+            table *= table
+        if am == 0 or (density and part in ('exp', 'conj')):
+            # |exp(1j*am*theta)|^2 is 1, so a complex density has no theta
+            # factor
+            return table[rho_index]
+        plane = grid.azimuth()
+        azimuth = with_precision(theta_part(plane, am, part), dtype)
+        if density:
+            return table[rho_index] * (azimuth*azimuth)[:, :, None]
+        return table[rho_index] * azimuth[:, :, None]
+
+    def separable(self, r, theta, phi=None):
+        '''
+        Return psi on the tensor product of the radii r and the angles
+        (theta, phi) as a SeparableField, which keeps the radial and angular
+        factors apart. theta may also be a Grids.Grid. Each factor is only
+        evaluated on its own samples, and the full
+        len(r) x angles array is only formed if it is asked for.
+        '''
+        radial = np.asarray(self.radial(np.asarray(r)))
+        if isinstance(theta, Grids.Grid):
+            angular = self.angular(theta)
+        else:
+            angular = self.angular(*np.broadcast_arrays(theta, phi))
+        return SeparableField(radial, np.asarray(angular))
+
     def setBohr(self, bohr):
         '''Define the bohr oscillation'''
         self.bohr = bohr
 
+    def withBohr(self, bohr):
+        '''
+        Return a shallow copy with its own bohr oscillation. The copy shares
+        the angular and radial functions, so a cached orbital can be handed
+        to several owners without their bohr values clobbering each other.
+        '''
+        self.r_90p  # Resolve the lazy radius once so that every copy shares it
+        orbital = copy.copy(self)
+        orbital.bohr = bohr
+        return orbital
+
+
+class SeparableField(object):
+    '''
+    A wavefunction on a tensor product grid, held as a radial factor over
+    the radii and an angular factor over the angles, so that
+    field[i, ...] = radial[i] * angular. Shells, densities and integrals
+    are found from the factors without forming the dense array.
+    '''
+    def __init__(self, radial, angular):
+        self.radial = radial
+        self.angular = angular
+        self.shape = np.shape(radial) + np.shape(angular)
+
+    def dense(self):
+        '''Return the full array, with the radii along the first axes'''
+        return np.multiply.outer(self.radial, self.angular)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.dense(), dtype)
+
+    def shell(self, i):
+        '''Return the values on the shell at radius r[i]'''
+        return self.radial[i] * self.angular
+
+    def density(self):
+        '''Return |psi|^2, which is itself separable'''
+        return SeparableField((np.conj(self.radial)*self.radial).real,
+                              (np.conj(self.angular)*self.angular).real)
+
+    def integrate(self, radial_weights, angular_weights):
+        '''
+        Return the sum of the field times radial_weights (over the radii)
+        and angular_weights (over the angles), e.g. quadrature weights
+        including r**2 and sin(phi)
+        '''
+        return (np.sum(self.radial*radial_weights) *
+                np.sum(self.angular*angular_weights))
+
+
+class OrbitalCache(object):
+    '''
+    A bounded least recently used cache of Orbital objects keyed by their
+    quantum numbers (n, l, m, s, z). An Orbital holds closures and a few
+    numbers rather than arrays, so every entry is about the same size and
+    the count is the memory cap: entries are evicted once there are more
+    than maxsize of them. Hits and misses are counted for tuning.
+    '''
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.orbitals = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, n, l, m, s=1, z=1):
+        '''Return the cached orbital, building it on the first request'''
+        key = (n, l, m, s, z)
+        with self.lock:
+            if key in self.orbitals:
+                self.hits += 1
+                self.orbitals.move_to_end(key)
+                return self.orbitals[key]
+            self.misses += 1
+        orbital = Orbital(n, l, m, s, z)
+        with self.lock:
+            if key not in self.orbitals:
+                self.orbitals[key] = orbital
+                self.evict()
+            return self.orbitals.get(key, orbital)
+
+    def evict(self):
+        '''Drop least recently used entries until there are maxsize left'''
+        while len(self.orbitals) > max(1, self.maxsize):
+            self.orbitals.popitem(last=False)
+
+    def stats(self):
+        '''Return a dictionary of the cache counters'''
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self.orbitals)}
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.orbitals
+
+    def __len__(self):
+        with self.lock:
+            return len(self.orbitals)
+
+    def clear(self):
+        with self.lock:
+            self.orbitals.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class OrbitalRegistry(Mapping):
+    '''
+    A dict-like collection of named orbitals. Nothing is built until an
+    orbital is first looked up, either by name ('3dxy') or by a tuple of
+    quantum numbers (n, l, m[, s[, z]]).
+    '''
+    def __init__(self, names, cache=None):
+        self.names = OrderedDict(names)
+        self.cache = OrbitalCache() if cache is None else cache
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            if key not in self:
+                raise KeyError(key)
+            return self.cache.get(*key)
+        return self.cache.get(*self.names[key])
+
+    def __contains__(self, key):
+        if isinstance(key, tuple):
+            return 3 <= len(key) <= 5 and valid_numbers(*key)
+        return key in self.names
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
+def valid_numbers(n, l, m, s=1, z=1):
+    '''
+    Whether the numbers describe an orbital which can be built: integers
+    0 <= l < n, m either an integer with |m| <= l or the name of one of l's
+    real orbitals, and a positive nuclear charge z
+    '''
+    if not (isinstance(n, numbers.Integral) and
+            isinstance(l, numbers.Integral) and 0 <= l < n):
+        return False
+    if not (isinstance(s, numbers.Number) and isinstance(z, numbers.Real) and
+            z > 0):
+        return False
+    if isinstance(m, str):
+        return m in real_combinations.get(l, {})
+    return isinstance(m, numbers.Integral) and abs(m) <= l
+
+
+# The Kernels module and backend name while fused kernels are selected
+kernels = None
+kernel_backend = None
+
+
+def set_kernels(backend=None):
+    '''
+    Evaluate the angular and radial functions of every orbital with the
+    fused kernels in Kernels.py, using the 'numexpr', 'numba' or 'numpy'
+    backend, or go back to the formulas in this module with None. Raises
+    ValueError if the backend isn't installed.
+    '''
+    global kernels, kernel_backend
+    if backend is None:
+        kernels = kernel_backend = None
+        return
+    import Kernels
+    Kernels.require(backend)
+    kernels, kernel_backend = Kernels, backend
+
 
 def get_angular(l, m, s):
     '''
     Return the angular wavefunction for the given l, m values.
-    Performance is 60x faster for equations explicitly written in the
-    dictionaries, but as a last resort just returning scipy.special.sph_harm
-    will get the job done for arbitrarily high quantum numbers.
+    The most common harmonics are written explicitly in the dictionaries,
+    and any higher l falls back to the associated Legendre recurrence in
+    spherical_harmonic, which works for arbitrarily high quantum numbers.
+    The returned function also accepts a Grids.Grid in place of theta, phi.
     '''
     if l == 0 or l == 's':
         angular = lambda theta, phi: np.ones_like(theta)*s*0.5/sqrtpi
@@ -149,82 +408,376 @@ def get_angular(l, m, s):
         angular = lambda theta, phi: s*p_dict[m](theta, phi)
     elif l == 2 or l == 'd':
         angular = lambda theta, phi: s*d_dict[m](theta, phi)
+    elif (l == 3 or l == 'f') and m in real_combinations[3]:
+        # The real f formulas are complex combinations, so use the real form
+        angular = lambda theta, phi: real_harmonic(3, m, s, theta, phi)
     elif l == 3 or l == 'f':
         angular = lambda theta, phi: s*f_dict[m](theta, phi)
     elif l == 4 or l == 'g':
         angular = lambda theta, phi: s*g_dict[m](theta, phi)
+    elif is_real(l, m):
+        angular = lambda theta, phi: real_harmonic(l, m, s, theta, phi)
     else:
-        angular = lambda theta, phi: s * sh(m, l, theta, phi)
-    return angular
+        angular = lambda theta, phi: s*spherical_harmonic(l, m, theta, phi)
+
+    def evaluate(theta, phi=None):
+        if isinstance(theta, Grids.Grid):
+            return angular_on_grid(l, m, s, theta)
+        if kernels is not None and isinstance(s, numbers.Real):
+            # The kernels have real coefficients, so a complex s keeps to
+            # the formulas
+            return kernels.angular_kernel(l, m, s, kernel_backend)(theta, phi)
+        return angular(theta, phi)
+    return evaluate
+
+
+def angular_on_grid(l, m, s, grid):
+    '''
+    Evaluate the angular wavefunction on a Grids.Grid, reusing the Legendre
+    functions and phase factors cached on the grid. Real orbitals come back
+    as real arrays.
+    '''
+    l = l_numbers.get(l, l)
+    if l == 0:
+        return np.full(np.shape(grid.theta), s*0.5/sqrtpi,
+                       float_type(grid.cos_phi))
+    am, coefficient, part = angular_parts(l, m, s)
+    return coefficient*legendre_on_grid(l, am, grid)*theta_part(grid, am, part)
+
+
+def is_real(l, m):
+    '''Whether the angular wavefunction for l, m is real valued'''
+    am, coefficient, part = angular_parts(l, m, 1)
+    return part in ('cos', 'sin')
+
+
+def real_harmonic(l, m, s, theta, phi):
+    '''
+    Evaluate a real angular wavefunction (see is_real) as a real array,
+    coefficient * P_l,am(cos(phi)) * cos or sin(am*theta)
+    '''
+    am, coefficient, part = angular_parts(l, m, s)
+    trig = cos if part == 'cos' else sin
+    return coefficient*associated_legendre(l, am, cos(phi), sin(phi)) * \
+        trig(am*theta)
+
+
+def float_type(array):
+    '''
+    Return the dtype to compute in for an array: its own for float32 and
+    float64 arrays, otherwise float64
+    '''
+    dtype = np.asarray(array).dtype
+    return dtype if dtype in (np.float32, np.float64) else np.dtype(float)
+
+
+def with_precision(array, dtype):
+    '''
+    Cast an array to a float dtype, or to the complex dtype of the same
+    precision if the array is complex. dtype None leaves it alone.
+    '''
+    if dtype is None:
+        return array
+    if np.iscomplexobj(array):
+        dtype = np.result_type(dtype, np.complex64)
+    return np.asarray(array, dtype)
+
+
+def angular_parts(l, m, s):
+    '''
+    Split the angular wavefunction into
+    coefficient * P_l,am(cos(phi)) * part of exp(1j*am*theta)
+    and return (am, coefficient, part). part is 'exp', 'conj', 'cos' or
+    'sin', so real orbitals (including every m = 0) only ever have a cos or
+    sin part.
+    '''
+    l = l_numbers.get(l, l)
+    if l == 0:
+        return 0, s, 'cos'
+    if m in real_combinations.get(l, {}):
+        m, a, b = real_combinations[l][m]
+    else:
+        a, b = None, None
+    am = abs(m)
+    if a is None and m < 0:
+        return am, s*(-1)**am, 'conj'
+    if a is None and m == 0:
+        return am, s, 'cos'
+    if a is None:
+        return am, s, 'exp'
+    if m == 0:
+        return am, s*a, 'cos'
+    # a*Y(l, m) + b*Y(l, -m) reduces to a real multiple of cos or sin(m*theta)
+    cos_part = a + (-1)**m*b
+    sin_part = 1j*(a - (-1)**m*b)
+    if abs(cos_part) > abs(sin_part):
+        return am, s*cos_part.real, 'cos'
+    return am, s*sin_part.real, 'sin'
+
+
+def legendre_on_grid(l, am, grid):
+    '''Return the associated Legendre function, cached on the grid'''
+    return grid.table(('legendre', l, am), lambda: associated_legendre(
+        l, am, grid.cos_phi, grid.sin_phi))
+
+
+def theta_part(grid, m, part):
+    '''Return the named part of exp(1j*m*theta) on a grid'''
+    if part == 'exp':
+        return grid.phase(m)
+    if part == 'conj':
+        return grid.phase(-m)
+    if m == 0:
+        return 1
+    if part == 'cos':
+        return grid.phase(m).real
+    return grid.phase(m).imag
+
+
+def legendre_column(l_max, m, cos_phi, sin_phi):
+    '''
+    Yield the normalized associated Legendre functions for l = m..l_max at a
+    fixed m >= 0. The spherical harmonic normalization and the
+    Condon-Shortley phase are included, so Y_lm = P_lm * exp(1j*m*theta).
+    Only the previous two degrees are kept while stepping up in l.
+    '''
+    p_lm = np.full(np.shape(cos_phi), 0.5/sqrtpi, float_type(cos_phi))
+    for k in range(1, m+1):
+        p_lm = -sqrt((2*k+1)/(2*k))*sin_phi*p_lm
+    yield p_lm
+    if l_max == m:
+        return
+    p_prev, p_lm = p_lm, sqrt(2*m+3)*cos_phi*p_lm
+    yield p_lm
+    for l in range(m+2, l_max+1):
+        a = sqrt((4*l*l-1)/(l*l-m*m))
+        b = sqrt(((l-1)*(l-1)-m*m)/(4*(l-1)*(l-1)-1))
+        p_prev, p_lm = p_lm, a*(cos_phi*p_lm-b*p_prev)
+        yield p_lm
+
+
+def associated_legendre(l, m, cos_phi, sin_phi):
+    '''
+    Return the normalized associated Legendre function for a single l and
+    m >= 0, as defined in legendre_column.
+    '''
+    for p_lm in legendre_column(l, m, cos_phi, sin_phi):
+        pass
+    return p_lm
+
+
+def spherical_harmonic(l, m, theta, phi):
+    '''
+    Return the complex spherical harmonic Y_lm for a single l, m pair using
+    the associated Legendre recurrence.
+    '''
+    am = abs(m)
+    p_lm = associated_legendre(l, am, cos(phi), sin(phi))
+    if m < 0:
+        return (-1)**am*p_lm*exp(-1j*am*theta)
+    return p_lm*exp(1j*am*theta)
+
+
+def sph_harm_l(l, theta, phi, real=False):
+    '''
+    Return every spherical harmonic of degree l evaluated on the theta, phi
+    grid, stacked along the first axis in the order m = -l..l.
+    Set real=True for the real (x, y, z style) harmonics instead, which use
+    sin(|m|*theta) for m < 0 and cos(m*theta) for m > 0.
+    '''
+    return sph_harm_all(l, theta, phi, real=real, l_min=l)
+
+
+def sph_harm_all(l_max, theta, phi, real=False, l_min=0):
+    '''
+    Return every spherical harmonic with l_min <= l <= l_max evaluated on
+    the theta, phi grid, stacked along the first axis. Y_lm is found at
+    index l*l + l + m - l_min*l_min.
+    The trigonometric terms are computed once and shared by every l, m, and
+    exp(1j*m*theta) is built up by repeated multiplication.
+    '''
+    theta, phi = np.broadcast_arrays(theta, phi)
+    cos_phi = cos(phi)
+    sin_phi = sin(phi)
+    offset = l_min*l_min
+    dtype = float if real else complex
+    harmonics = np.empty(((l_max+1)**2-offset,)+theta.shape, dtype=dtype)
+    step = exp(1j*theta)
+    phase = np.ones(theta.shape, dtype=complex)
+    for m in range(l_max+1):
+        for l, p_lm in enumerate(legendre_column(l_max, m, cos_phi, sin_phi),
+                                 m):
+            if l < l_min:
+                continue
+            index = l*l + l - offset
+            if real and m == 0:
+                harmonics[index] = p_lm
+            elif real:
+                # Drop the Condon-Shortley phase for the real harmonics
+                p_lm = (-1)**m*sqrt2*p_lm
+                harmonics[index+m] = p_lm*phase.real
+                harmonics[index-m] = p_lm*phase.imag
+            else:
+                harmonics[index+m] = p_lm*phase
+                if m:
+                    harmonics[index-m] = (-1)**m*p_lm*np.conj(phase)
+        phase *= step
+    return harmonics
 
 
 def get_radial(n, l, z):
     '''
-    Return the radial wavefunction for the given n, z, z values.
-    Performance is improved for the equations which are explicitly written
-    in the dictionary, but as a last resort the Lagrange polynomial is
-    generated programmatically.
+    Return the radial wavefunction for the given n, l, z values.
+    The lowest shells are written explicitly in the radials dictionary. Any
+    other shell is built from the closed form generalized Laguerre
+    polynomial, whose coefficients are computed once per (n, l, z).
+    The returned function also accepts a Grids.Grid in place of r.
     '''
-    if n <= 5:
+    key = "{}{}".format(n, l)
+    if key in radials:
         # Typing in the functions explicitly allows speed optimization
-        radial = lambda r: radials["{}{}".format(n, l)](r, z)
-    elif l == n - 1:
-        print("L is N-1")
-        radial = lambda r: r**(n-1)*np.exp(-z*r/n)
-        rvals = np.arange(0,200,0.01)
-        integral = 0
-        for r in rvals:
-            radial_val = radial(r)
-            integral = integral + r*r*radial_val*radial_val/100
-        radial = lambda r: r**(n-1)*np.exp(-z*r/n)/integral
+        radial = lambda r: radials[key](r, z)
     else:
-        # General form for arbitrarily large quantum numbers
-        radial = lambda r: 2
-        # TODO http://quantummechanics.ucsd.edu/ph130a/130_notes/node237.html#derive:Hradial
-    return radial
+        coefficients, decay = radial_coefficients(n, l, z)
+        radial = lambda r: evaluate_radial(r, l, coefficients, decay)
+
+    def evaluate(r):
+        if isinstance(r, Grids.Grid):
+            r = r.r
+        if kernels is not None:
+            return kernels.radial_kernel(n, l, z, kernel_backend)(r)
+        return radial(r)
+    return evaluate
+
+
+@lru_cache(maxsize=256)
+def radial_coefficients(n, l, z):
+    '''
+    Return the polynomial coefficients (highest power first) and decay
+    constant of the normalized radial wavefunction, so that
+    R_nl(r) = r**l * poly(r) * exp(-decay*r)
+    The normalization and the generalized Laguerre coefficients are combined
+    in log space so that large quantum numbers don't overflow.
+    '''
+    if not 0 <= l < n:
+        raise ValueError("l must satisfy 0 <= l < n, got n={}, l={}".format(n, l))
+    k = n - l - 1
+    alpha = 2*l + 1
+    scale = 2*z/n
+    log_norm = 0.5*(3*log(scale) + lgamma(k+1) - log(2*n) - lgamma(n+l+1))
+    coefficients = []
+    for i in range(k+1):
+        # (-1)^i C(k+alpha, k-i) / i! for the Laguerre polynomial in
+        # rho = scale*r, with rho**(l+i) folded back into powers of r
+        log_c = (lgamma(k+alpha+1) - lgamma(k-i+1) - lgamma(alpha+i+1) -
+                 lgamma(i+1) + (l+i)*log(scale) + log_norm)
+        coefficients.append(float((-1)**i*exp(log_c)))
+    return tuple(reversed(coefficients)), z/n
+
+
+def evaluate_radial(r, l, coefficients, decay):
+    '''
+    Evaluate r**l * poly(r) * exp(-decay*r) with Horner's rule, updating a
+    single array in place.
+    '''
+    r = np.asarray(r, dtype=float_type(r))
+    radial = np.full(r.shape, coefficients[0], r.dtype)
+    for coefficient in coefficients[1:]:
+        radial *= r
+        radial += coefficient
+    if l:
+        radial *= r**l
+    radial *= np.exp(-decay*r)
+    return radial[()]
 
 
 def get_90p(radial):
     '''
-    Numerically integrate the radial function. Return radius
-    which encloses 90%.
-    '''
-    r_range = np.arange(0, 50, 0.01)
-    total = 0
-    index = 0
-    r_val = 0
-    while(total < 0.9):
-        r_val = r_range[index]
-        y_val = radial(r_val)
-        total = total + y_val*y_val*r_val*r_val/100
-        index += 1
-    return r_val
-
-orbitals = {'1s': Orbital(1, 0, 0),
-            '2s': Orbital(2, 0, 0),
-            '2pz': Orbital(2, 1, 0),
-            '2px': Orbital(2, 1, 'x'),
-            '2py': Orbital(2, 1, 'y'),
-            '2p1': Orbital(2, 1, 1),
-            '2p-1': Orbital(2, 1, -1),
-            '3s': Orbital(3, 0, 0),
-            '3pz': Orbital(3, 1, 'z'),
-            '3px': Orbital(3, 1, 'x'),
-            '3py': Orbital(3, 1, 'y'),
-            '3p1': Orbital(3, 1, 1),
-            '3p-1': Orbital(3, 1, -1),
-            '3dz^2': Orbital(3, 2, 0),
-            '3dxz': Orbital(3, 2, 'xz'),
-            '3dyz': Orbital(3, 2, 'yz'),
-            '3dx^2-y^2': Orbital(3, 2, 'x^2-y^2'),
-            '3dxy': Orbital(3, 2, 'xy'),
-            '4fz^3': Orbital(4,3, 'z^3'),
-            '4fxz^2': Orbital(4, 3, 'xz^2'),
-            '4fyz^2': Orbital(4, 3, 'yz^2'),
-            '4fxyz': Orbital(4, 3, 'xyz'),
-            '4fz(x^2-y^2)': Orbital(4, 3, 'z(x^2-y^2)'),
-            '4fx(x^2-3y^2)': Orbital(4, 3, 'x(x^2-3y^2)'),
-            '4fy(3x^2-y^2)': Orbital(4, 3, 'y(3x^3-y^2)')}
+    Return the radius which encloses 90% of the electron density.
+    '''
+    return get_radius(radial, 0.9)
+
+
+def get_radius(radial, fraction, r_max=50, samples=5000):
+    '''
+    Numerically integrate the radial function along a whole array of radii
+    at once and return the radius which encloses the given fraction of the
+    electron density. If the fraction isn't reached by r_max the range is
+    doubled until it is, so diffuse high n orbitals are still found, and if
+    it is reached within the first tenth of the samples (or the density
+    peaks within the first few) the range is shrunk, so compact orbitals
+    such as those of a large z are resolved too.
+    '''
+    if not 0 < fraction < 1:
+        raise ValueError("fraction must be between 0 and 1, got {}".format(
+            fraction))
+    for _ in range(100):
+        if r_max > 1e6:
+            break
+        r = np.linspace(0, r_max, samples + 1)
+        density = np.abs(radial(r))**2*r*r
+        enclosed = np.empty_like(density)
+        enclosed[0] = 0
+        # Cumulative trapezoid rule
+        np.cumsum(density[1:] + density[:-1], out=enclosed[1:])
+        enclosed *= 0.5*(r[1] - r[0])
+        index = np.searchsorted(enclosed, fraction)
+        peak = np.argmax(density)
+        if index > samples and peak < samples // 100:
+            # The density peaks between the first few samples, so the
+            # integral is too coarse to ever reach the fraction
+            r_max = 20*r[peak + 1]
+            continue
+        if index < samples // 10:
+            # Too few samples below the radius, so zoom in on it
+            r_max = 2*r[index]
+            continue
+        if index <= samples:
+            # Interpolate linearly between the bracketing samples
+            low, high = enclosed[index - 1], enclosed[index]
+            return r[index - 1] + (r[index] - r[index - 1])*(fraction - low)/(high - low)
+        r_max = 2*r_max
+    raise ValueError("The radial function never encloses {} of the "
+                     "density. Is it normalized?".format(fraction))
+
+
+orbital_cache = OrbitalCache()
+
+
+def get_orbital(n, l, m, s=1, z=1):
+    '''
+    Return the shared, memoized Orbital for these quantum numbers. Use
+    Orbital.withBohr to get a copy with a particular bohr oscillation.
+    '''
+    return orbital_cache.get(n, l, m, s, z)
+
+
+orbitals = OrbitalRegistry({'1s': (1, 0, 0),
+            '2s': (2, 0, 0),
+            '2pz': (2, 1, 0),
+            '2px': (2, 1, 'x'),
+            '2py': (2, 1, 'y'),
+            '2p1': (2, 1, 1),
+            '2p-1': (2, 1, -1),
+            '3s': (3, 0, 0),
+            '3pz': (3, 1, 'z'),
+            '3px': (3, 1, 'x'),
+            '3py': (3, 1, 'y'),
+            '3p1': (3, 1, 1),
+            '3p-1': (3, 1, -1),
+            '3dz^2': (3, 2, 0),
+            '3dxz': (3, 2, 'xz'),
+            '3dyz': (3, 2, 'yz'),
+            '3dx^2-y^2': (3, 2, 'x^2-y^2'),
+            '3dxy': (3, 2, 'xy'),
+            '4fz^3': (4, 3, 'z^3'),
+            '4fxz^2': (4, 3, 'xz^2'),
+            '4fyz^2': (4, 3, 'yz^2'),
+            '4fxyz': (4, 3, 'xyz'),
+            '4fz(x^2-y^2)': (4, 3, 'z(x^2-y^2)'),
+            '4fx(x^2-3y^2)': (4, 3, 'x(x^2-3y^2)'),
+            '4fy(3x^2-y^2)': (4, 3, 'y(3x^3-y^2)')},
+                           cache=orbital_cache)
 
 # The MIT License (MIT)
 #
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+# This program is licenced under an MIT license. Full licence is at the end of
+# this file.
+"""
+Kernels.py
+Fused kernels for the angular and radial wavefunctions in Hydrogenic.
+
+The formulas in Hydrogenic's dictionaries are chains of NumPy operations,
+each of which allocates a full sized temporary. Here every angular function
+is written as the single expression
+    coefficient * sin(phi)**|m| * Q(cos(phi)) * (part of exp(1j*|m|*theta))
+with Q a polynomial, and every radial function as
+    r**l * poly(r) * exp(-decay*r)
+which is then compiled into one loop by whichever backend is chosen:
+
+'numexpr' - evaluated in cache sized blocks by numexpr
+'numba'   - compiled into a ufunc with numba.vectorize
+'numpy'   - the same expression with plain NumPy, always available
+
+On 150**3 points numexpr is about 1.1-1.5x faster than the formulas for
+angular functions and about even for radial ones, and Numba about
+1.2-2x. The numpy backend saves no passes over memory and is often
+slower than the formulas, so it is mainly a reference for the others.
+
+numexpr and Numba are optional and only imported when their backend is
+used. Select a backend with Hydrogenic.set_kernels and check it against the
+reference formulas with verify.
+
+@author: Matthew B Rowley
+"""
+from __future__ import division
+from functools import lru_cache, partial
+import importlib.util
+from math import factorial, pi, sqrt
+import numbers
+import re
+import numpy as np
+import Hydrogenic as hyd
+
+backends = ('numexpr', 'numba', 'numpy')
+
+
+def available():
+    '''Return the backends which can be used on this machine'''
+    return tuple(backend for backend in backends
+                 if backend == 'numpy' or importlib.util.find_spec(backend))
+
+
+def require(backend):
+    '''Raise ValueError unless the backend can be used'''
+    if backend not in backends:
+        raise ValueError("Unknown kernel backend {!r}, choose from {}"
+                         .format(backend, backends))
+    if backend not in available():
+        raise ValueError("The {} backend needs {} to be installed"
+                         .format(backend, backend))
+
+
+@lru_cache(maxsize=256)
+def legendre_polynomial(l, am):
+    '''
+    Return the coefficients (lowest power first) of the polynomial Q with
+    P_l,am(cos(phi)) = sin(phi)**am * Q(cos(phi)), where P is the normalized
+    associated Legendre function of Hydrogenic.legendre_column. Q follows
+    the same recurrence, applied to polynomials.
+    '''
+    q = np.array([0.5/hyd.sqrtpi])
+    for k in range(1, am+1):
+        q = -hyd.sqrt((2*k+1)/(2*k))*q
+    if l == am:
+        return tuple(q)
+    q_prev, q = q, hyd.sqrt(2*am+3)*np.concatenate(([0], q))
+    for degree in range(am+2, l+1):
+        a = hyd.sqrt((4*degree*degree-1)/(degree*degree-am*am))
+        b = hyd.sqrt(((degree-1)*(degree-1)-am*am) /
+                     (4*(degree-1)*(degree-1)-1))
+        shifted = np.concatenate(([0], q))
+        shifted[:len(q_prev)] -= b*q_prev
+        q_prev, q = q, a*shifted
+    return tuple(q)
+
+
+def horner(coefficients, x):
+    '''Write a polynomial (lowest power first) in x as an expression'''
+    expression = repr(float(coefficients[-1]))
+    for coefficient in reversed(coefficients[:-1]):
+        if coefficient:
+            expression = '{!r} + {}*({})'.format(float(coefficient), x,
+                                                 expression)
+        else:
+            expression = '{}*({})'.format(x, expression)
+    return expression
+
+
+def power(x, exponent):
+    '''Write x**exponent as a product, which every backend handles alike'''
+    return '*'.join([x]*exponent)
+
+
+@lru_cache(maxsize=256)
+def angular_expression(l, m, s):
+    '''Return the angular wavefunction as an expression in theta and phi'''
+    l = hyd.l_numbers.get(l, l)
+    am, coefficient, part = hyd.angular_parts(l, m, s)
+    factors = [repr(float(coefficient)),
+               '({})'.format(horner(legendre_polynomial(l, am), 'cos(phi)'))]
+    if am:
+        factors.append(power('sin(phi)', am))
+    if part in ('exp', 'conj'):
+        sign = '+' if part == 'exp' else '-'
+        factors.append('(cos({0}*theta) {1} 1j*sin({0}*theta))'
+                       .format(am, sign))
+    elif am:
+        factors.append('{}({}*theta)'.format(part, am))
+    return '*'.join(factors)
+
+
+@lru_cache(maxsize=256)
+def radial_expression(n, l, z):
+    '''Return the radial wavefunction as an expression in r'''
+    coefficients, decay = hyd.radial_coefficients(n, l, z)
+    factors = ['({})'.format(horner(coefficients[::-1], 'r')),
+               'exp({!r}*r)'.format(-float(decay))]
+    if l:
+        factors.append(power('r', l))
+    return '*'.join(factors)
+
+
+# Room for an angular and a radial kernel for each orbital in
+# Hydrogenic.orbital_cache; Numba's compiled ufuncs are the largest entries
+@lru_cache(maxsize=128)
+def compile_expression(expression, names, backend):
+    '''
+    Compile an expression in the given variable names for a backend. The
+    result has the precision of the arguments, as with the formulas in
+    Hydrogenic: float32 arguments give float32 (or complex64) results.
+    '''
+    if backend == 'numexpr':
+        import numexpr
+        # numexpr only takes the names which appear in the expression
+        used = [i for i, name in enumerate(names)
+                if re.search(r'\b{}\b'.format(name), expression)]
+        compiled = numexpr.NumExpr(expression, [(names[i], np.double)
+                                                for i in used])
+
+        def function(*args):
+            args = np.broadcast_arrays(*[np.asarray(arg, dtype=float)
+                                         for arg in args])
+            return compiled(*[args[i] for i in used])
+    else:
+        source = 'lambda {}: {}'.format(', '.join(names), expression)
+        if backend == 'numba':
+            import math
+            import numba
+            function = numba.vectorize(cache=False)(eval(
+                source, {'sin': math.sin, 'cos': math.cos, 'exp': math.exp}))
+        else:
+            function = eval(source, {'sin': np.sin, 'cos': np.cos,
+                                     'exp': np.exp})
+
+    def evaluate(*args):
+        # numexpr and Numba work in double precision, so cast back after
+        dtype = np.result_type(*[hyd.float_type(arg) for arg in args])
+        return hyd.with_precision(
+            function(*[np.asarray(arg, dtype) for arg in args]), dtype)
+    return evaluate
+
+
+def angular_kernel(l, m, s, backend):
+    '''
+    Return the fused angular wavefunction for a backend. The expressions
+    hold real coefficients, so s must be real.
+    '''
+    if not isinstance(s, numbers.Real):
+        raise ValueError("The fused kernels need a real s, got {!r}"
+                         .format(s))
+    if hyd.l_numbers.get(l, l) == 0:
+        value = s*0.5/hyd.sqrtpi
+        return lambda theta, phi: np.full(
+            np.broadcast(theta, phi).shape, value,
+            np.result_type(hyd.float_type(theta), hyd.float_type(phi)))
+    return compile_expression(angular_expression(l, m, s), ('theta', 'phi'),
+                              backend)
+
+
+def radial_kernel(n, l, z, backend):
+    '''Return the fused radial wavefunction for a backend'''
+    return compile_expression(radial_expression(n, l, z), ('r',), backend)
+
+
+def verify(backend, tolerance=1e-10, samples=1000, seed=0):
+    '''
+    Compare a backend's kernels against the hand-written formulas in
+    Hydrogenic's dictionaries, and against reference_harmonic and
+    reference_radial for a few generated functions. None of these share
+    code with the kernels. Returns a list of (function, error) for those
+    whose largest error relative to their peak exceeds the tolerance, so
+    an empty list means the backend agrees.
+    '''
+    require(backend)
+    random = np.random.default_rng(seed)
+    theta = random.uniform(0, 2*np.pi, samples)
+    phi = random.uniform(0, np.pi, samples)
+    r = random.uniform(0, 40, samples)
+    dictionaries = {1: hyd.p_dict, 2: hyd.d_dict, 3: hyd.f_dict,
+                    4: hyd.g_dict}
+    angulars = [(0, 0, lambda theta, phi: np.full(theta.shape,
+                                                  0.5/hyd.sqrtpi))]
+    angulars += [(l, m, formula) for l, dictionary in dictionaries.items()
+                 for m, formula in dictionary.items()]
+    angulars += [(l, m, partial(reference_harmonic, l, m))
+                 for l, m in [(5, 2), (6, -4), (7, 7)]]
+    radials = [(int(key[0]), int(key[1]), formula)
+               for key, formula in hyd.radials.items()]
+    radials += [(n, l, partial(reference_radial, n, l))
+                for n, l in [(4, 2), (6, 3), (10, 0)]]
+    failures = []
+    for l, m, formula in angulars:
+        reference = formula(theta, phi)
+        error = np.max(np.abs(angular_kernel(l, m, 1, backend)(theta, phi) -
+                              reference)) / np.max(np.abs(reference))
+        if not error <= tolerance:
+            failures.append(('angular l={} m={}'.format(l, m), error))
+    for n, l, formula in radials:
+        for z in (1, 3):
+            reference = formula(r, z)
+            error = np.max(np.abs(radial_kernel(n, l, z, backend)(r) -
+                                  reference)) / np.max(np.abs(reference))
+            if not error <= tolerance:
+                failures.append(('radial n={} l={} z={}'.format(n, l, z),
+                                 error))
+    return failures
+
+
+def reference_harmonic(l, m, theta, phi):
+    '''
+    The complex spherical harmonic Y_lm from the Rodrigues formula, with the
+    Legendre polynomial differentiated by numpy.polynomial, independently
+    of the recurrences used by Hydrogenic and legendre_polynomial
+    '''
+    am = abs(m)
+    derivative = np.polynomial.Legendre.basis(l).deriv(am)(np.cos(phi))
+    norm = sqrt((2*l+1)/(4*pi)*factorial(l-am)/factorial(l+am))
+    harmonic = ((-1)**am*norm*np.sin(phi)**am*derivative *
+                np.exp(1j*am*theta))
+    if m < 0:
+        return (-1)**am*np.conj(harmonic)
+    return harmonic
+
+
+def reference_radial(n, l, r, z):
+    '''
+    The radial wavefunction from the three term recurrence of the
+    generalized Laguerre polynomials, independently of
+    Hydrogenic.radial_coefficients
+    '''
+    rho = 2*z*r/n
+    k, alpha = n - l - 1, 2*l + 1
+    previous, laguerre = np.zeros_like(rho), np.ones_like(rho)
+    for j in range(k):
+        previous, laguerre = laguerre, ((2*j + 1 + alpha - rho)*laguerre -
+                                        (j + alpha)*previous)/(j + 1)
+    norm = sqrt((2*z/n)**3*factorial(k)/(2*n*factorial(n+l)))
+    return norm*np.exp(-rho/2)*rho**l*laguerre
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Matthew B. Rowley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
@@ -11,6 +11,8 @@ hydrogenic wavefunctions.
 
 from __future__ import division
 import os
+import threading
+import time
 
 # This must be called before importing traits and mayavi elements
 # os.environ["ETS_TOOLKIT"] = "qt5"
@@ -22,12 +24,12 @@ from traits.api import HasTraits, Instance
 from traitsui.api import View, Item
 from mayavi.core.ui.api import MayaviScene, MlabSceneModel, SceneEditor
 import Hydrogenic as hyd
+import Grids
+import Animations
 import numpy as np
 import pyqtgraph as pg
 import pickle
 
-sqrt2 = np.sqrt(2)
-
 
 class MainWindow(QtGui.QMainWindow):
     """Main Window for the UI"""
@@ -54,12 +56,28 @@ class MainWindow(QtGui.QMainWindow):
         self.mayavi_widget = MayaviQWidget(self.frame)
         self.layout.addWidget(self.mayavi_widget)
         self.setCentralWidget(self.frame)
+        # Show the playback statistics while an animation runs
+        self.stats_timer = QtCore.QTimer()
+        self.stats_timer.timeout.connect(self.showStats)
+        self.stats_timer.start(500)
         self.changeTab()  # Create the visualization after the UI is made
 
     def closeEvent(self, evt):
         global calculator
         QtGui.QMainWindow.closeEvent(self, evt)
+        self.stats_timer.stop()
         calculator.animation_timer.stop()
+        calculator.stopFrameCache()
+        calculator.worker.stop()
+
+    def showStats(self):
+        """Show the playback statistics of whichever animation is running"""
+        global calculator
+        for animation in [calculator] + self.findChildren(CrossingPanel):
+            if animation.animating:
+                self.statusBar().showMessage(animation.pacer.summary())
+                return
+        self.statusBar().clearMessage()
 
     def changeTab(self):
         """A new tab has been selected. It may be necessary to reinitialize
@@ -360,6 +378,7 @@ class CrossingPanel(QtGui.QWidget):
         self.animating = False
         self.animation_timer = QtCore.QTimer()
         self.animation_timer.timeout.connect(self.animateFrame)
+        self.pacer = Animations.FramePacer(0.05)
         self.vid_frame = 0
 
     def changeCurves(self):
@@ -399,14 +418,19 @@ class CrossingPanel(QtGui.QWidget):
             data = (self.bond_lengths[i], self.Low_A_MO[i], self.High_A_MO[i])
         else:
             data = (self.bond_lengths[i], self.Low_D_MO[i], self.High_D_MO[i])
-        points.writePoints((data))
+        points.write(data)
 
     def animateFrame(self):
-        self.renderFrame()
-        self.curser.setValue(self.bond_lengths[self.vid_frame])
-        self.vid_frame = self.vid_frame + 1
+        # Show whichever frame is due now, skipping any that rendering missed
+        self.vid_frame = self.pacer.due()
         if self.vid_frame >= 100:
+            self.vid_frame = 100
             self.animationPressed()
+            return
+        with self.pacer.measure("render"):
+            self.renderFrame()
+        self.pacer.shown(self.vid_frame)
+        self.curser.setValue(self.bond_lengths[self.vid_frame])
 
     def renderFrame(self):
         self.preparePoints()
@@ -421,6 +445,7 @@ class CrossingPanel(QtGui.QWidget):
             if self.vid_frame >= 100:
                 self.vid_frame = 0
             self.curser.sigPositionChanged.disconnect()
+            self.pacer.start(self.vid_frame)
             self.animation_timer.start(50)
             self.animating = True
 
@@ -559,7 +584,7 @@ class Visualization(HasTraits):
     def createOrbital(self):
         global points
         self.scene.mlab.clf()
-        x, y, z, psi = points.readPoints()
+        self.generation, (x, y, z, psi) = points.read()
         self.mesh = self.scene.mlab.mesh(
             x, y, z, scalars=psi, colormap="hsv", vmax=np.pi, vmin=-np.pi
         )
@@ -579,22 +604,30 @@ class Visualization(HasTraits):
         self.axes = self.scene.mlab.axes()
         self.fig = self.scene.mlab.gcf()
         self.source = self.mesh.mlab_source
+        self.shown = {}
+        self.remember("mesh points", (x, y, z))
+        self.remember("mesh scalars", psi)
+        self.bounds = bounds(x, y, z)
         if zoom.read():
             self.scene.mlab.view(0, 90, np.max((x, y, z)) * 5, (0, 0, 0))
             self.scene.reset_zoom()
 
     def updateOrbital(self):
         global points, zoom
-        x, y, z, psi = points.readPoints()
-        self.source.set(x=x, y=y, z=z, scalars=psi)
+        generation, (x, y, z, psi) = points.read()
+        if generation == self.generation:
+            return  # Nothing new since the last update
+        self.generation = generation
+        # Stationary states only change phase, so usually only the scalars move
+        if not self.updateMesh(self.source, "mesh", x, y, z, psi):
+            return
         if zoom.read():
             self.scene.reset_zoom()
-        self.axes.remove()
-        self.axes = self.scene.mlab.axes()
+        self.refreshAxes(bounds(x, y, z))
 
     def createCrossing(self):
         self.scene.mlab.clf()
-        bond_length, Low, High = points.readPoints()
+        self.generation, (bond_length, Low, High) = points.read()
         self.High_mesh = self.scene.mlab.mesh(
             High[0], High[1], High[2], color=(0.9, 0.1, 0.1), opacity=1
         )
@@ -612,21 +645,102 @@ class Visualization(HasTraits):
         self.Br_source = self.Br_point.mlab_source
         self.Low_source = self.Low_mesh.mlab_source
         self.High_source = self.High_mesh.mlab_source
+        self.shown = {}
+        self.remember("Low points", tuple(Low))
+        self.remember("High points", tuple(High))
+        self.bond_length = bond_length
+        self.bounds = crossing_bounds(bond_length, Low, High)
         self.scene.mlab.view(0, 90, roll=0, focalpoint=(0, 0, 0))
         if zoom.read():
             self.scene.reset_zoom()
 
     def updateCrossing(self):
-        bond_length, Low, High = points.readPoints()
-        self.Low_source.set(x=Low[0], y=Low[1], z=Low[2])
-        self.High_source.set(x=High[0], y=High[1], z=High[2])
-        self.Br_source.set(x=0, y=0, z=bond_length)
+        generation, (bond_length, Low, High) = points.read()
+        if generation == self.generation:
+            return
+        self.generation = generation
+        moved = self.updateMesh(self.Low_source, "Low", *Low)
+        moved = self.updateMesh(self.High_source, "High", *High) or moved
+        if bond_length != self.bond_length:
+            self.bond_length = bond_length
+            self.Br_source.set(x=0, y=0, z=bond_length)
+            moved = True
+        if not moved:
+            return
         if zoom.read():
             self.scene.reset_zoom()
+        self.refreshAxes(crossing_bounds(bond_length, Low, High))
+
+    def remember(self, name, values):
+        """
+        Keep a copy of the values last uploaded under name, and return whether
+        they differ from the previous ones
+        """
+        shown = self.shown.get(name)
+        if shown is not None and shown.shape == np.shape(values):
+            if np.array_equal(shown, values):
+                return False
+            shown[...] = values
+        else:
+            self.shown[name] = np.array(values)
+        return True
+
+    def updateMesh(self, source, name, x, y, z, scalars=None):
+        """
+        Write whichever of a mesh's points and scalars have changed into its
+        VTK arrays in place, and return whether anything changed
+        """
+        moved = self.remember(name + " points", (x, y, z))
+        recoloured = scalars is not None and self.remember(name + " scalars", scalars)
+        if not (moved or recoloured):
+            return False
+        dataset = source.dataset
+        if np.shape(dataset.points.to_array()) != (np.size(x), 3):
+            # The mesh changed size, so it has to be rebuilt
+            if scalars is None:
+                source.reset(x=x, y=y, z=z)
+            else:
+                source.reset(x=x, y=y, z=z, scalars=scalars)
+            return True
+        if moved:
+            view = dataset.points.to_array()
+            for axis, values in enumerate((x, y, z)):
+                view[:, axis] = np.ravel(values)
+            dataset.points.modified()
+        if recoloured:
+            view = dataset.point_data.scalars.to_array()
+            view[:] = np.ravel(scalars)
+            dataset.point_data.scalars.modified()
+        source.update()
+        return True
+
+    def refreshAxes(self, new_bounds, tolerance=0.02):
+        """
+        Rebuild the axes only once the data has moved more than tolerance (as
+        a fraction of its size) away from the bounds they were drawn for
+        """
+        size = np.max(np.abs(self.bounds))
+        if np.max(np.abs(new_bounds - self.bounds)) <= tolerance * size:
+            return
+        self.bounds = new_bounds
         self.axes.remove()
         self.axes = self.scene.mlab.axes()
 
 
+def bounds(x, y, z):
+    """Return the (xmin, xmax, ymin, ymax, zmin, zmax) of the points"""
+    return np.array(
+        [np.min(x), np.max(x), np.min(y), np.max(y), np.min(z), np.max(z)]
+    )
+
+
+def crossing_bounds(bond_length, Low, High):
+    """The bounds of both molecular orbital surfaces and the two atoms"""
+    atoms = [0, 0, 0, 0, min(0, bond_length), max(0, bond_length)]
+    stacked = np.array([bounds(*Low), bounds(*High), atoms])
+    return np.where(np.arange(6) % 2, stacked.max(axis=0), stacked.min(axis=0))
+
+
 class MayaviQWidget(QtGui.QWidget):
     """
     Widget containing the visualization
@@ -670,13 +784,27 @@ class OrbitalCalculator(object):
         self.rabi = False
         self.fid = False
         self.animating = False
-        self.i = 0
-        self.phi, self.theta = np.mgrid[0 : np.pi : 50j, 0 : 2 * np.pi : 100j]
+        self.i = 0  # The next frame to show
+        self.uploaded = 0  # Store generation of the last frame uploaded
+        self.interval = 40  # Milliseconds between animation frames
+        # The frame on screen follows the wall clock, skipping frames if late
+        self.pacer = Animations.FramePacer(self.interval / 1000)
+        # Frames are computed ahead of playback on a background thread
+        self.worker = FrameWorker(self.points, self.pacer)
+        self.worker.start()
+        # Precompute the periodic coherence animations in the background
+        # while they play, keeping at most frame_cache_bytes of float32
+        # frames
+        self.cache_frames = True
+        self.frame_cache_bytes = 128 * 2**20
+        self.frame_cache = None
+        # The trig basis of this mesh is computed once and shared
+        self.grid = Grids.get_spherical_grid(50, 100)
         self.signals.orbital_change.connect(self.orbitalChange)
         self.signals.animate_orbital.connect(self.animateClicked)
         self.signals.cycle_change.connect(self.cycleChanged)
         self.animation_timer = QtCore.QTimer()
-        self.animation_timer.timeout.connect(self.runStationary)
+        self.animation_timer.timeout.connect(self.runAnimation)
 
     def writeMode(self, new_mode):
         """
@@ -684,6 +812,8 @@ class OrbitalCalculator(object):
         """
         self.animation_timer.stop()
         self.animating = False
+        self.worker.clearJob()
+        self.stopFrameCache()
         self.mode = new_mode
         self.animation_timer = QtCore.QTimer()
         if self.mode == "Stationary States":
@@ -695,13 +825,13 @@ class OrbitalCalculator(object):
 
     def stationaryMode(self):
         """Prepare the visualization for stationary states mode"""
-        self.animation_timer.timeout.connect(self.runStationary)
+        self.animation_timer.timeout.connect(self.runAnimation)
         self.times = np.linspace(0, 2 * np.pi, 100)
         self.changeStationary(first=True)
 
     def coherencesMode(self):
         """Prepare the visualization for coherences mode"""
-        self.animation_timer.timeout.connect(self.runCoherence)
+        self.animation_timer.timeout.connect(self.runAnimation)
         self.zoom.write(False)
         self.changeCoherence(first=True)
 
@@ -713,15 +843,11 @@ class OrbitalCalculator(object):
     def changeStationary(self, first=False):
         """Update the visualization when a new orbital is selected."""
         self.orbital = self.stationary_orbital.read()
-        self.r = self.orbital.r_90p
-        self.x = self.r * np.sin(self.phi) * np.cos(self.theta)
-        self.y = self.r * np.sin(self.phi) * np.sin(self.theta)
-        self.z = self.r * np.cos(self.phi)
-        self.rs = (
-            np.conj(self.orbital.angular(self.theta, self.phi))
-            * self.orbital.angular(self.theta, self.phi)
-        ).real
-        # self.rs = self.rs / np.max(self.rs) * self.r
+        # The angular amplitude is cached here; frames only advance its phase
+        self.kernel = Animations.stationary_kernel(self.grid, self.orbital)
+        # Switch the worker first, so no frame of the old kernel can be
+        # written after this one
+        self.startWorker()
         self.calculateStationary()
         self.zoom.write(True)
         if first:
@@ -735,15 +861,20 @@ class OrbitalCalculator(object):
         self.bra = self.bra_orbital.read()
         if self.coherence is True:
             self.times = np.linspace(0, 2 * np.pi, 1000)
-            self.radial = self.radialNoCycle
-            self.angular = self.angularNoCycle
+            self.kernel = Animations.coherence_kernel(self.grid, self.ket, self.bra)
         else:
-            self.radial = self.radialRabiCycle
-            self.angular = self.angularRabiCycle
+            self.kernel = Animations.rabi_kernel(self.grid, self.ket, self.bra)
             if self.rabi is True:
                 self.times = np.linspace(0, 2 * np.pi, 1000)
             else:
                 self.times = np.linspace(np.pi / 4, np.pi / 2.0, 125)
+        # The old cycle is useless now, and a new one is only worth
+        # computing while an animation plays
+        if self.animating:
+            self.startFrameCache()
+        else:
+            self.stopFrameCache()
+        self.startWorker()
         self.calculateCoherence()
         if first:
             self.signals.create_orbital.emit()
@@ -761,94 +892,181 @@ class OrbitalCalculator(object):
         """Start or stop the animation"""
         if not self.animating:
             self.zoom.write(False)  # Zooming during animations is disorienting
-            self.animation_timer.start(40)
             self.animating = True
+            if self.mode == "Coherences" and self.frame_cache is None:
+                self.startFrameCache()
+            self.pacer.start(self.i)
+            self.startWorker()
+            self.animation_timer.start(self.interval)
         else:
             self.animation_timer.stop()
             self.animating = False
+            self.worker.clearJob()
 
     def cycleChanged(self):
         cycle_vals = cycle.read()
         self.coherence, self.rabi, self.fid = cycle_vals
         self.changeCoherence()
 
-    def runStationary(self):
-        self.calculateStationary()
-        self.i = self.i + 1
-        self.signals.update_orbital.emit()
+    def startWorker(self):
+        """Have the worker produce frames for the current kernel"""
+        if self.animating:
+            self.worker.setJob(self.kernel, self.times, self.i, self.frame_cache)
+
+    def runAnimation(self):
+        """
+        Upload the newest frame the worker has written to the store. The
+        worker writes frames as they fall due by the wall clock, so if
+        computing or rendering fell behind, the frames which should already
+        have been shown are dropped instead of being played back late.
+        """
+        published = self.worker.latest()
+        if published is None or published[0] == self.uploaded:
+            return  # The worker is behind, so keep showing the current frame
+        self.uploaded, index = published
+        self.i = index + 1
+        with self.pacer.measure("render"):
+            self.signals.update_orbital.emit()
+        self.pacer.shown(index)
 
     def calculateStationary(self):
         time = self.times[self.i % len(self.times)]
-        psi = np.angle(
-            self.orbital.angular(self.theta, self.phi)
-            * np.exp(1j * self.orbital.bohr * time)
-        )
-        data = (self.rs * self.x, self.rs * self.y, self.rs * self.z, psi)
-        self.points.writePoints(data)
-
-    def runCoherence(self):
-        self.calculateCoherence()
-        self.signals.update_orbital.emit()
-        self.i = self.i + 1
+        self.points.write(self.kernel.frame(time))
 
     def calculateCoherence(self):
-        t = self.times[self.i % len(self.times)]
-        r = self.radial(t)
-        x = r * np.sin(self.phi) * np.cos(self.theta)
-        y = r * np.sin(self.phi) * np.sin(self.theta)
-        z = r * np.cos(self.phi)
-        angular = self.angular(self.theta, self.phi, t)
-        rs = (np.conj(angular) * angular).real
-        # rs = rs / np.max(rs)
-        psi = np.angle(angular)
-        data = (rs * x, rs * y, rs * z, psi)
-        self.points.writePoints(data)
-
-    def radialNoCycle(self, t):
-        radius = 0.5 * (self.ket.r_90p + self.bra.r_90p)
-        return radius
-
-    def angularNoCycle(self, theta, phi, t):
-        return (
-            0.5
-            * sqrt2
-            * (
-                np.exp(1j * self.ket.bohr * t) * self.ket.angular(theta, phi)
-                + np.exp(1j * self.bra.bohr * t) * self.bra.angular(theta, phi)
+        frame = None
+        if self.frame_cache is not None:
+            frame = self.frame_cache.get(self.i)
+        if frame is None:
+            # The cache hasn't reached this frame yet
+            frame = self.kernel.frame(self.times[self.i % len(self.times)])
+        self.points.write(frame)
+
+    def startFrameCache(self):
+        """
+        Start filling a new frame cache for the current coherence kernel,
+        stopping (and joining) the thread of the one it replaces
+        """
+        self.stopFrameCache()
+        if self.cache_frames:
+            self.frame_cache = Animations.FrameCache(
+                self.kernel, self.times, self.frame_cache_bytes
             )
-        )
 
-    def radialRabiCycle(self, t):
-        radius = (
-            np.sin(t) * np.sin(t) * self.ket.r_90p
-            + np.cos(t) * np.cos(t) * self.bra.r_90p
-        )
-        return radius
+    def stopFrameCache(self):
+        """Stop the frame cache's thread and drop its frames"""
+        if self.frame_cache is not None:
+            self.frame_cache.stop()
+            self.frame_cache = None
+
+
+class FrameWorker(QtCore.QThread):
+    """
+    Computes animation frames on a background thread and writes each one
+    straight into the FrameStore when it falls due, so the GUI thread only
+    reads the store and uploads the newest frame. If rendering falls behind,
+    frames the GUI never read are replaced in the store by newer ones.
+    """
 
-    def angularRabiCycle(self, theta, phi, t):
-        return np.sin(t) * np.exp(1j * self.ket.bohr * t) * self.ket.angular(
-            theta, phi
-        ) + np.cos(t) * np.exp(1j * self.bra.bohr * t) * self.bra.angular(theta, phi)
+    def __init__(self, store, pacer=None):
+        QtCore.QThread.__init__(self)
+        self.store = store
+        self.pacer = pacer
+        self.condition = threading.Condition()
+        self.job = None
+        self.generation = 0
+        # (store generation, frame index) of the newest frame written
+        self.published = None
+        self.running = True
+
+    def setJob(self, kernel, times, start, frame_cache=None):
+        """Produce frames from start onwards, abandoning the previous job"""
+        with self.condition:
+            self.generation += 1
+            self.job = (kernel.copy(), times, start, frame_cache)
+            self.published = None
+            self.condition.notify_all()
+
+    def clearJob(self):
+        with self.condition:
+            self.generation += 1
+            self.job = None
+            self.published = None
+            self.condition.notify_all()
+
+    def latest(self):
+        """
+        Return (store generation, frame index) for the newest frame written
+        for the current job, or None if there isn't one yet
+        """
+        with self.condition:
+            return self.published
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.wait()
+
+    def run(self):
+        generation = None
+        while True:
+            with self.condition:
+                while self.running and self.job is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                if generation != self.generation:
+                    generation = self.generation
+                    kernel, times, index, frame_cache = self.job
+            if self.pacer is not None:
+                # Don't compute frames which playback has already skipped
+                index = max(index, self.pacer.due())
+            start = time.perf_counter()
+            frame = None
+            if frame_cache is not None:
+                frame = frame_cache.get(index)
+            if frame is None:
+                frame = kernel.frame(times[index % len(times)])
+            if self.pacer is not None:
+                self.pacer.record("compute", time.perf_counter() - start)
+            with self.condition:
+                # Hold the frame back until it is due
+                while (
+                    self.running
+                    and generation == self.generation
+                    and self.pacer is not None
+                    and self.pacer.until(index) > 0
+                ):
+                    self.condition.wait(self.pacer.until(index))
+                if not self.running or generation != self.generation:
+                    continue
+                # Written under the condition, so once setJob or clearJob
+                # returns no frame of the old job can reach the store
+                self.published = (self.store.write(frame), index)
+            index = index + 1
 
 
 class OrbitalMutex(QtCore.QMutex):
     """
     Stores a Hydrogenic.Orbital object
+
+    Orbitals come from the shared Hydrogenic.orbital_cache, so revisiting a
+    set of quantum numbers doesn't rebuild anything. Each mutex keeps its own
+    copy so that its bohr oscillation doesn't leak into the other mutexes.
     """
 
     def __init__(self, orbital=hyd.orbitals["2pz"], bohr=1):
         QtCore.QMutex.__init__(self)
         self.bohr = bohr
-        self.orbital = orbital
-        self.orbital.setBohr(self.bohr)
+        self.orbital = orbital.withBohr(self.bohr)
 
     def read(self):
         return self.orbital
 
     def writeName(self, new_name):
         self.lock()
-        self.orbital = hyd.orbitals[new_name]
-        self.orbital.setBohr(self.bohr)
+        self.orbital = hyd.orbitals[new_name].withBohr(self.bohr)
         self.unlock()
 
     def writeNumbers(self, new_numbers):
@@ -857,26 +1075,7 @@ class OrbitalMutex(QtCore.QMutex):
         l = new_numbers[1]
         m = new_numbers[2]
         s = new_numbers[3]
-        self.orbital = hyd.Orbital(n, l, m, s)
-        self.orbital.setBohr(self.bohr)
-        self.unlock()
-
-
-class PointsMutex(QtCore.QMutex):
-    """
-    Stores the points for visualization
-    """
-
-    def __init__(self):
-        QtCore.QMutex.__init__(self)
-        self.points = (0, 0, 0, 0)
-
-    def readPoints(self):
-        return self.points
-
-    def writePoints(self, new_points):
-        self.lock()
-        self.points = new_points
+        self.orbital = hyd.get_orbital(n, l, m, s).withBohr(self.bohr)
         self.unlock()
 
 
@@ -920,7 +1119,7 @@ signals = SignalBus()
 stationary_orbital = OrbitalMutex(orbital=hyd.orbitals["1s"], bohr=1)
 bra_orbital = OrbitalMutex(orbital=hyd.orbitals["2pz"], bohr=50)
 ket_orbital = OrbitalMutex(orbital=hyd.orbitals["1s"], bohr=10)
-points = PointsMutex()
+points = Animations.FrameStore()
 zoom = BoolMutex(init_value=True)
 cycle = BoolMutex(init_value=[True, False, False])
 calculator = OrbitalCalculator(
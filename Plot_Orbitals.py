@@ -11,28 +11,26 @@
 from __future__ import division
 import numpy as np
 import Hydrogenic as hyd
+import Grids
+import Volumes
 from mayavi import mlab
 
-x, y, z = np.mgrid[- 20:20:150j, - 20:20:150j, - 20:20:150j]
-r = np.sqrt(x ** 2 + y ** 2 + z ** 2)
-phi = np.arccos(z/r)
-theta = np.arctan(y/x)
+grid = Grids.get_cartesian_grid(20, 150)
+x, y, z = grid.x, grid.y, grid.z
 
 orbital = hyd.Orbital(3, 1, 0, 1)
-L = orbital.radial
-A = orbital.angular
-Psi = L(r) * A(theta, phi)
-Phi = (np.conj(Psi)*Psi).real
-phase = np.angle(Psi)
+Psi = orbital.evaluate(grid)
+Phi = Volumes.density(Psi)
+phase = Volumes.phase(Psi)
 
-x2, y2, z2 = np.mgrid[- 20:20:150j, - 0.1:20:75j, - 20:20:150j]
-r2 = np.sqrt(x2 ** 2 + y2 ** 2 + z2 ** 2)
-phi2 = np.arccos(z2/r2)
-theta2 = np.arctan(y2/x2)
+# The half of the box with y > 0, for cutaway views
+grid2 = Grids.get_cartesian_grid(((-20, 20), (-0.1, 20), (-20, 20)),
+                                 (150, 75, 150))
+x2, y2, z2 = grid2.x, grid2.y, grid2.z
 
-Psi2 = L(r2) * A(theta2, phi2)
-Phi2 = (np.conj(Psi2)*Psi2).real
-phase2 = np.angle(Psi2)
+Psi2 = orbital.evaluate(grid2)
+Phi2 = Volumes.density(Psi2)
+phase2 = Volumes.phase(Psi2)
 
 if True: # Iso phase coloring
     # Plot it ####################################################################
@@ -175,36 +173,11 @@ if False: # Scaled Sphere
     mlab.show()
 #-------------------------------------------------------------------------------------
 if True: # points
-    num = 400j
-    xp, yp, zp = np.ogrid[- 35:35:num, - 35:35:num, - 35:35:num]
-    rp = np.sqrt(xp ** 2 + yp ** 2 + zp ** 2)
-    phip = np.arccos(zp/rp)
-    thetap = np.arctan(yp/xp)
-    psip = orbital.angular(thetap, phip) * orbital.radial(rp)
-    anglep = np.angle(psip)
-    densityp = (np.conj(psip)*psip).real
-    xpoints = []
-    ypoints= []
-    zpoints = []
-    psipoints=[]
-    max_density = np.max(densityp) * 20
-    xp = np.ndarray.flatten(xp)
-    yp = np.ndarray.flatten(yp)
-    zp = np.ndarray.flatten(zp)
-    for i, this_x in enumerate(xp):
-        for j, this_y in enumerate(yp):
-            for k, this_z in enumerate(zp):
-                this_density = densityp[i][j][k]
-                this_angle = - psip[i][j][k].real
-                if np.random.rand()*max_density < this_density:
-                    xpoints.append(this_x)
-                    ypoints.append(this_y)
-                    zpoints.append(this_z)
-                    psipoints.append(this_angle)
-    xpoints = np.array(xpoints)
-    ypoints = np.array(ypoints)
-    zpoints = np.array(zpoints)
-    psipoints = - np.array(psipoints)  # take the negative to match with the phase colormap colors
+    # Draw the points straight from the density, coloured by Re(psi)
+    xpoints, ypoints, zpoints, _ = Volumes.sample_points(orbital, 10000)
+    rpoints = np.sqrt(xpoints ** 2 + ypoints ** 2 + zpoints ** 2)
+    psipoints = orbital.psi(rpoints, np.arctan2(ypoints, xpoints),
+                            np.arccos(zpoints/rpoints)).real
     print(len(xpoints), len(ypoints), len(zpoints), len(psipoints))
     mlab.figure(1, fgcolor=(0, 0, 0), bgcolor=(1, 1, 1))
     mlab.points3d(xpoints, ypoints, zpoints, -psipoints, colormap="jet", scale_mode='none', scale_factor=0.2)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# This program is licenced under an MIT license. Full licence is at the end of
+# this file.
+"""
+Render_Orbitals.py
+Render a catalog of orbital images without opening any windows.
+
+Jobs come from a JSON file holding a list of objects such as
+    {"orbital": "3dxy", "style": "iso-phase", "resolution": 150,
+     "extent": 20, "camera": [-10, 90], "size": [800, 800]}
+or from the cross product of --orbitals and --styles. Only "orbital" and
+"style" are required. The orbital is a name from Hydrogenic.orbitals or an
+[n, l, m] list, the style is one of Renderers.styles, and "camera" is
+passed to mlab.view. "options" holds extra keyword arguments for the style
+and "output" overrides the file name.
+
+Jobs are shared between worker processes which each render offscreen.
+Jobs whose output file already exists are skipped, so an interrupted
+catalog build picks up where it stopped. Examples:
+
+    python Render_Orbitals.py jobs.json --output renders --workers 8
+    python Render_Orbitals.py --orbitals 2px 3dxy --styles iso-phase points
+
+@author: Matthew B Rowley
+"""
+from __future__ import division
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+defaults = {'resolution': None, 'extent': 20, 'camera': [-10, 90],
+            'size': [800, 800], 'options': {}}
+
+
+def load_jobs(path):
+    '''Read a list of jobs from a JSON file'''
+    with open(path) as f:
+        jobs = json.load(f)
+    if not isinstance(jobs, list):
+        raise ValueError("{} should hold a list of jobs".format(path))
+    return jobs
+
+
+def cross_jobs(orbitals, styles, **settings):
+    '''Return a job for every combination of orbital and style'''
+    return [dict(settings, orbital=orbital, style=style)
+            for orbital in orbitals for style in styles]
+
+
+def prepare(job, directory, image_format='png'):
+    '''
+    Fill in the defaults for a job and the path of its output, which is
+    named after the orbital, style and resolution unless given
+    '''
+    for key in ('orbital', 'style'):
+        if key not in job:
+            raise ValueError("Job {} has no {!r}".format(job, key))
+    job = dict(defaults, **job)
+    if 'output' not in job:
+        orbital = job['orbital']
+        if not isinstance(orbital, str):
+            orbital = '_'.join(str(number) for number in orbital)
+        parts = [orbital, job['style']]
+        if job['resolution'] is not None:
+            parts.append(str(job['resolution']))
+        job['output'] = '{}.{}'.format('_'.join(parts), image_format)
+    job['output'] = os.path.join(directory, job['output'])
+    return job
+
+
+def pending(jobs, force=False):
+    '''Return the jobs whose output doesn't exist yet (all of them if force)'''
+    return [job for job in jobs if force or not os.path.exists(job['output'])]
+
+
+def start_worker():
+    '''Worker process setup: render offscreen, without a window'''
+    from mayavi import mlab
+    mlab.options.offscreen = True
+
+
+def render_job(job):
+    '''
+    Render one job in a worker process and return (output, seconds, error).
+    The image is written under a temporary name and moved into place once
+    complete, so a killed run never leaves a file that looks finished.
+    '''
+    import Hydrogenic as hyd
+    import Renderers
+    start = time.time()
+    try:
+        orbital = job['orbital']
+        if isinstance(orbital, str):
+            orbital = hyd.orbitals[orbital]
+        else:
+            orbital = hyd.get_orbital(*orbital)
+        root, extension = os.path.splitext(job['output'])
+        temporary = '{}.partial{}'.format(root, extension)
+        Renderers.render(orbital, job['style'], temporary, job['resolution'],
+                         job['extent'], job['camera'], job['size'],
+                         job['options'])
+        os.replace(temporary, job['output'])
+    except Exception as error:
+        return job['output'], time.time() - start, repr(error)
+    return job['output'], time.time() - start, None
+
+
+def run(jobs, workers=None):
+    '''
+    Render the jobs on a pool of worker processes, printing each result,
+    and return the number that failed
+    '''
+    if not jobs:
+        return 0
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    # Fresh processes rather than forks, since VTK state doesn't survive a
+    # fork, and recycled now and then in case it leaks
+    context = multiprocessing.get_context('spawn')
+    failures = 0
+    with context.Pool(workers, initializer=start_worker,
+                      maxtasksperchild=20) as pool:
+        for output, seconds, error in pool.imap_unordered(render_job, jobs):
+            if error:
+                failures += 1
+                print("FAILED {} ({})".format(output, error))
+            else:
+                print("{} ({:.1f} s)".format(output, seconds))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Render orbital images offscreen in parallel")
+    parser.add_argument('jobs', nargs='?', help="JSON file with a job list")
+    parser.add_argument('--orbitals', nargs='+', default=[],
+                        help="orbital names, rendered in every --styles")
+    parser.add_argument('--styles', nargs='+', default=['iso-phase'],
+                        help="styles for --orbitals (default iso-phase)")
+    parser.add_argument('--resolution', type=int,
+                        help="grid resolution for --orbitals")
+    parser.add_argument('--output', default='renders',
+                        help="directory for the images (default renders)")
+    parser.add_argument('--format', default='png',
+                        help="image format for unnamed outputs")
+    parser.add_argument('--workers', type=int,
+                        help="worker processes (default one per core)")
+    parser.add_argument('--force', action='store_true',
+                        help="render jobs even if their output exists")
+    args = parser.parse_args(argv)
+    jobs = load_jobs(args.jobs) if args.jobs else []
+    jobs += cross_jobs(args.orbitals, args.styles,
+                       resolution=args.resolution)
+    if not jobs:
+        parser.error("give a job file or --orbitals")
+    jobs = [prepare(job, args.output, args.format) for job in jobs]
+    todo = pending(jobs, args.force)
+    print("{} jobs, {} already rendered".format(len(jobs),
+                                                len(jobs) - len(todo)))
+    os.makedirs(args.output, exist_ok=True)
+    return 1 if run(todo, args.workers) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Matthew B. Rowley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
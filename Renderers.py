@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+# This program is licenced under an MIT license. Full licence is at the end of
+# this file.
+"""
+Renderers.py
+Mayavi drawing routines for the rendering styles in Plot_Orbitals.py, so
+that they can be run without any windows by Render_Orbitals.py.
+
+Every style draws one orbital into the current mlab figure and is called as
+style(orbital, resolution=..., extent=..., **options).
+
+export_animation writes an animation from Animations to a video or a
+numbered image sequence, stepping its clock frame by frame rather than in
+real time. Computing, rendering and encoding frames overlap: frames are
+computed ahead on worker threads, rendered offscreen on the calling thread
+and encoded on another thread (or by an ffmpeg process for videos).
+
+@author: Matthew B Rowley
+"""
+from __future__ import division
+import os
+import queue
+import struct
+import subprocess
+import threading
+import zlib
+from mayavi import mlab
+import numpy as np
+import Animations
+import Grids
+import Volumes
+
+
+class IsoSurface(object):
+    '''
+    An isosurface of the density on a Cartesian grid, coloured by the phase
+    of psi, drawn in the current figure. The Mayavi pipeline is built once;
+    update writes each new density and phase into the VTK arrays in place
+    and moves the contour, so an animation never rebuilds the pipeline or
+    the colorbar.
+    '''
+    def __init__(self, grid, density, phase, isovalue, colorbar=True):
+        self.shape = np.shape(density)
+        self.source = mlab.pipeline.scalar_field(grid.x, grid.y, grid.z,
+                                                 density)
+        # The phase array must have exactly the layout of the dataset
+        point_data = self.source.image_data.point_data
+        point_data.add_array(phase.T.ravel())
+        point_data.get_array(1).name = 'angle'
+        self.source.update()
+        self.arrays = [point_data.get_array(0), point_data.get_array(1)]
+        # Views of the VTK arrays, indexed like the grid (VTK runs x fastest)
+        self.views = [array.to_array().reshape(self.shape, order='F')
+                      for array in self.arrays]
+        self.contour = mlab.pipeline.contour(
+            mlab.pipeline.set_active_attribute(self.source))
+        self.contour.filter.contours = [isovalue]
+        coloured = mlab.pipeline.set_active_attribute(self.contour,
+                                                      point_scalars='angle')
+        self.surface = mlab.pipeline.surface(coloured, colormap='hsv',
+                                             vmax=np.pi, vmin=-np.pi)
+        if colorbar:
+            mlab.colorbar(self.surface, title='Phase',
+                          orientation='vertical', nb_labels=5)
+
+    def update(self, density, phase, isovalue):
+        '''Show a new density and phase, contoured at isovalue'''
+        for view, array, values in zip(self.views, self.arrays,
+                                       (density, phase)):
+            view[...] = values
+            array.modified()
+        self.contour.filter.contours = [isovalue]
+        self.source.update()
+
+
+def iso_phase(orbital, resolution=150, extent=20, fraction=0.75,
+              colorbar=True):
+    '''
+    An isosurface enclosing the given fraction of the density, coloured by
+    the phase of psi
+    '''
+    grid = Grids.get_cartesian_grid(extent, resolution)
+    psi = orbital.evaluate(grid)
+    density = Volumes.density(psi)
+    IsoSurface(grid, density, Volumes.phase(psi),
+               Volumes.isovalue_for_fraction(density, fraction),
+               colorbar=colorbar)
+
+
+def volume(orbital, resolution=150, extent=20, colorbar=True):
+    '''A volume rendering of the density'''
+    grid = Grids.get_cartesian_grid(extent, resolution)
+    density = orbital.evaluate(grid, density=True)
+    src = mlab.pipeline.scalar_field(grid.x, grid.y, grid.z, density)
+    mlab.pipeline.volume(src, vmin=0)
+    if colorbar:
+        mlab.colorbar(title='Density', orientation='vertical', nb_labels=5,
+                      label_fmt='%.0e')
+
+
+def scaled_sphere(orbital, resolution=80, extent=None, colorbar=True):
+    '''
+    The angular density as the distance from the origin in each direction,
+    scaled to the 90% radius and coloured by phase
+    '''
+    grid = Grids.get_spherical_grid(resolution, 2*resolution)
+    psi = orbital.angular(grid)
+    rs = Volumes.density(psi)
+    rs = orbital.r_90p * rs / np.max(rs)
+    angles = np.abs(Volumes.phase(psi)) - np.pi
+    mlab.mesh(rs*grid.x, rs*grid.y, rs*grid.z, scalars=angles,
+              colormap='hsv', vmax=np.pi, vmin=-np.pi)
+    if colorbar:
+        mlab.colorbar(title='Phase', orientation='vertical', nb_labels=5)
+
+
+def points(orbital, resolution=10000, extent=None, seed=0, colorbar=True):
+    '''
+    A cloud of resolution points drawn from the density, coloured by phase
+    '''
+    x, y, z, phase = Volumes.sample_points(orbital, resolution, seed)
+    mlab.points3d(x, y, z, phase, colormap='hsv', vmax=np.pi, vmin=-np.pi,
+                  scale_mode='none', scale_factor=0.2)
+    if colorbar:
+        mlab.colorbar(title='Phase', orientation='vertical', nb_labels=5,
+                      label_fmt='%.2f')
+
+
+styles = {'iso-phase': iso_phase,
+          'volume': volume,
+          'scaled-sphere': scaled_sphere,
+          'points': points}
+
+
+def render(orbital, style, path, resolution=None, extent=20,
+           camera=(-10, 90), size=(800, 800), options=None):
+    '''
+    Draw an orbital in one of the styles into a new figure, save it to path
+    and close the figure. camera is passed to mlab.view. Set
+    mlab.options.offscreen first to render without a window.
+    '''
+    kwargs = dict(options or {})
+    if resolution is not None:
+        kwargs['resolution'] = resolution
+    figure = mlab.figure(size=tuple(size), fgcolor=(0, 0, 0),
+                         bgcolor=(1, 1, 1))
+    try:
+        styles[style](orbital, extent=extent, **kwargs)
+        mlab.view(*camera)
+        mlab.savefig(path, figure=figure)
+    finally:
+        mlab.close(figure)
+
+
+def write_png(path, image):
+    '''Write an (height, width, 3) uint8 RGB image to a PNG file'''
+    height, width = image.shape[:2]
+    # Every row starts with a zero byte, for no filtering
+    rows = np.zeros((height, 1 + 3*width), np.uint8)
+    rows[:, 1:] = image.reshape(height, -1)
+
+    def chunk(kind, data):
+        checksum = zlib.crc32(kind + data) & 0xffffffff
+        return struct.pack('>I', len(data)) + kind + data + \
+            struct.pack('>I', checksum)
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', header))
+        f.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+
+class ImageSequence(object):
+    '''
+    Writes frames to PNG files named by a pattern such as
+    'frames/rabi_{:04d}.png', which is formatted with the frame number
+    '''
+    def __init__(self, pattern):
+        self.pattern = pattern
+        directory = os.path.dirname(pattern)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, index, image):
+        write_png(self.pattern.format(index), image)
+
+    def close(self):
+        pass
+
+
+class VideoEncoder(object):
+    '''
+    Pipes raw RGB frames to an ffmpeg process, which encodes them in the
+    format given by the path's extension (e.g. .webm, .mp4 or .gif)
+    '''
+    def __init__(self, path, fps=25, ffmpeg='ffmpeg'):
+        self.path = path
+        self.fps = fps
+        self.ffmpeg = ffmpeg
+        self.process = None
+
+    def start(self, width, height):
+        '''Start ffmpeg once the size of the frames is known'''
+        command = [self.ffmpeg, '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                   '-s', '{}x{}'.format(width, height),
+                   '-r', str(self.fps), '-i', '-']
+        if not self.path.lower().endswith('.gif'):
+            # Most players need even dimensions and 4:2:0 chroma
+            command += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+                        '-pix_fmt', 'yuv420p']
+        self.process = subprocess.Popen(command + [self.path],
+                                        stdin=subprocess.PIPE)
+
+    def write(self, index, image):
+        if self.process is None:
+            self.start(image.shape[1], image.shape[0])
+        self.process.stdin.write(np.ascontiguousarray(image).tobytes())
+
+    def close(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        if self.process.wait():
+            raise RuntimeError("ffmpeg failed to encode {}"
+                               .format(self.path))
+
+
+def encoder_for(path, fps=25):
+    '''
+    Return an ImageSequence if the path is a pattern with a {} field for the
+    frame number, otherwise a VideoEncoder
+    '''
+    if '{' in path:
+        return ImageSequence(path)
+    return VideoEncoder(path, fps)
+
+
+def encode(frames, encoder, errors):
+    '''
+    Encoder thread: write each (index, image) from the frames queue until
+    None arrives. Any error is appended to errors.
+    '''
+    try:
+        while True:
+            item = frames.get()
+            if item is None:
+                break
+            encoder.write(*item)
+        encoder.close()
+    except Exception as error:
+        errors.append(error)
+        # Keep draining so that the renderer never blocks on a full queue
+        while frames.get() is not None:
+            pass
+
+
+def export_animation(kernel, times, path, fps=25, size=(800, 800),
+                     camera=(0, 90), distance='auto', workers=2, depth=16,
+                     colormap='hsv'):
+    '''
+    Render an Animations kernel offscreen at each of the times, as in the
+    Orbitals application, and encode the frames to path (see encoder_for).
+    The camera is fixed at the given view, by default at a distance which
+    fits the first frame. Returns the number of frames written.
+    '''
+    offscreen = mlab.options.offscreen
+    mlab.options.offscreen = True
+    figure = mlab.figure(size=tuple(size), fgcolor=(0, 0, 0),
+                         bgcolor=(1, 1, 1))
+    images = queue.Queue(depth)
+    errors = []
+    encoder = threading.Thread(target=encode,
+                               args=(images, encoder_for(path, fps), errors))
+    encoder.start()
+    count = 0
+    try:
+        for x, y, z, phase in Animations.precompute(kernel, times, workers,
+                                                    depth):
+            if count == 0:
+                mesh = mlab.mesh(x, y, z, scalars=phase, colormap=colormap,
+                                 vmax=np.pi, vmin=-np.pi, figure=figure)
+                source = mesh.mlab_source
+                mlab.view(*camera, distance=distance, focalpoint=(0, 0, 0),
+                          figure=figure)
+            else:
+                source.set(x=x, y=y, z=z, scalars=phase)
+            images.put((count, mlab.screenshot(figure, mode='rgb')))
+            count += 1
+            if errors:
+                break
+    finally:
+        images.put(None)
+        encoder.join()
+        mlab.close(figure)
+        mlab.options.offscreen = offscreen
+    if errors:
+        raise errors[0]
+    return count
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Matthew B. Rowley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+# This program is licenced under an MIT license. Full licence is at the end of
+# this file.
+"""
+Volumes.py
+Tools for working with wavefunctions evaluated on three dimensional grids,
+such as the densities rendered by IsoSurfaces.py and Plot_Orbitals.py.
+
+@author: Matthew B Rowley
+"""
+from __future__ import division
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+from multiprocessing import shared_memory
+import os
+import numpy as np
+import Grids
+import Hydrogenic as hyd
+
+# Grid sized arrays alive per point while a slab is evaluated, counted in
+# units of the grid's float size: complex psi and its temporaries, the
+# density and the phase
+slab_footprint = 8
+
+
+def density(psi):
+    '''Return |psi|^2, without complex arithmetic when psi is real'''
+    if np.iscomplexobj(psi):
+        return (np.conj(psi)*psi).real
+    return psi*psi
+
+
+def phase(psi):
+    '''
+    Return the phase of psi in the range -pi..pi. For real psi that is just
+    the sign, 0 or pi, as in np.angle, without the arctan.
+    '''
+    if np.iscomplexobj(psi):
+        return np.angle(psi)
+    dtype = np.result_type(psi, np.float32)
+    return np.where(psi < 0, dtype.type(np.pi), dtype.type(0))
+
+
+def isovalue_for_fraction(density, fraction=0.75, previous=None,
+                          tolerance=0.02, samples=32768, passes=4):
+    '''
+    Return the isovalue whose isosurface encloses the given fraction of the
+    total density, i.e. the smallest value v such that the voxels with
+    density >= v hold at least that fraction.
+
+    Rather than sorting every voxel, the answer is bracketed: one pass sums
+    the density above the bracket and keeps the few voxels inside it, and
+    only those are sorted. Pass the previous frame's isovalue as previous to
+    bracket within tolerance of it; otherwise the bracket comes from a
+    coarse sample of the grid. A bracket which misses is moved towards the
+    answer and widened, so the result is always exact.
+
+    A bracket with no lower edge, as for fractions close to 1, would hold
+    most of the voxels, so then (or if the bracket still misses after the
+    given number of passes) every voxel is sorted instead.
+    '''
+    values = np.ravel(density)
+    if previous is not None and previous > 0:
+        low, high = previous / (1 + tolerance), previous * (1 + tolerance)
+    else:
+        low, high = sample_bracket(density, fraction, tolerance, samples)
+    total = None
+    ratio = 1 + tolerance
+    for _ in range(passes):
+        if low == -np.inf:
+            break
+        mass_above, inside, mass = bracket(values, low, high, total is None)
+        if total is None:
+            total = mass
+            target = fraction * total
+            if total <= 0:
+                return values.max()
+        inside = np.sort(inside)[::-1]
+        cumulative = mass_above + np.cumsum(inside, dtype=float)
+        # Extend a bracket which missed towards the answer, by more each
+        # time, until in the end it holds everything
+        if 0 < low and high < np.inf:
+            ratio = max(ratio, high / low)
+        ratio *= ratio
+        if mass_above >= target and mass_above > 0:
+            high = high * ratio if ratio < 1e6 else np.inf
+        elif low > -np.inf and (not inside.size or cumulative[-1] < target):
+            low = low / ratio if ratio < 1e6 else -np.inf
+        elif inside.size:
+            k = min(int(np.searchsorted(cumulative, target)), inside.size - 1)
+            return inside[k]
+        else:
+            return values.min()  # Rounding left the target beyond the total
+    return sorted_isovalue(values, fraction)
+
+
+def sorted_isovalue(values, fraction):
+    '''isovalue_for_fraction by sorting every value'''
+    ordered = np.sort(values)[::-1]
+    cumulative = np.cumsum(ordered, dtype=float)
+    if cumulative[-1] <= 0:
+        return ordered[0]
+    k = int(np.searchsorted(cumulative, fraction * cumulative[-1]))
+    return ordered[min(k, ordered.size - 1)]
+
+
+def bracket(values, low, high, totals=False, chunk=2**16):
+    '''
+    Return the sum of the values above high, the values from low to high
+    and, if totals, the sum of all the values. The values are read in chunks
+    which stay in cache across the comparisons, so the array is only
+    streamed from memory once.
+    '''
+    mass_above = total = 0.0
+    inside = []
+    for start in range(0, values.size, chunk):
+        part = values[start:start + chunk]
+        above = part > high
+        mass_above += np.add.reduce(part, where=above, dtype=float)
+        within = part >= low
+        within ^= above
+        inside.append(part[within])
+        if totals:
+            total += np.add.reduce(part, dtype=float)
+    return mass_above, np.concatenate(inside), total
+
+
+def sample_bracket(density, fraction, tolerance, samples):
+    '''
+    Estimate values enclosing fraction - tolerance and fraction + tolerance
+    of the density from about the given number of samples, taken on a
+    coarser lattice of the grid
+    '''
+    step = max(1, int(round((np.size(density) / samples) **
+                            (1 / np.ndim(density)))))
+    sample = np.asarray(density)[(slice(None, None, step),) * np.ndim(density)]
+    sample = np.sort(sample, axis=None)[::-1]
+    cumulative = np.cumsum(sample, dtype=float)
+    total = cumulative[-1]
+    high = np.inf
+    if fraction > tolerance:
+        k = np.searchsorted(cumulative, (fraction - tolerance) * total)
+        high = sample[min(k, sample.size - 1)]
+    low = -np.inf
+    if fraction + tolerance < 1:
+        k = np.searchsorted(cumulative, (fraction + tolerance) * total)
+        low = sample[min(k, sample.size - 1)]
+    return low, high
+
+
+def sample_points(orbital, n_points, seed=None, fraction=0.99999,
+                  samples=4096):
+    '''
+    Draw n_points positions at random from the density |psi|^2 of an
+    orbital and return their x, y, z and the phase of psi at each one.
+    seed may be anything np.random.default_rng accepts, including a
+    Generator, so that point clouds can be reproduced.
+
+    |psi|^2 r^2 sin(phi) separates into a function of r, one of phi and one
+    of theta, so each coordinate is drawn independently by inverting its
+    tabulated cumulative distribution (see sampling_tables). Radii are
+    drawn from the sphere which holds the given fraction of the density.
+    '''
+    random = np.random.default_rng(seed)
+    r_table, phi_table, theta_table = sampling_tables(
+        orbital.n, orbital.l, orbital.m, orbital.s, orbital.z, fraction,
+        samples)
+    r = draw(r_table, n_points, random)
+    phi = draw(phi_table, n_points, random)
+    if theta_table is None:
+        theta = 2*np.pi*random.random(n_points)
+    else:
+        theta = draw(theta_table, n_points, random)
+    sin_phi, cos_phi = np.sin(phi), np.cos(phi)
+    cos_theta, sin_theta = np.cos(theta), np.sin(theta)
+    # psi from its separated factors, reusing the sines and cosines above
+    l = hyd.l_numbers.get(orbital.l, orbital.l)
+    am, coefficient, part = hyd.angular_parts(l, orbital.m, orbital.s)
+    psi = coefficient*orbital.radial(r)*hyd.associated_legendre(
+        l, am, cos_phi, sin_phi)
+    if am:
+        cos_m = cos_theta if am == 1 else np.cos(am*theta)
+        sin_m = sin_theta if am == 1 else np.sin(am*theta)
+        if part == 'cos':
+            psi *= cos_m
+        elif part == 'sin':
+            psi *= sin_m
+        else:
+            psi = psi*(cos_m + (1j if part == 'exp' else -1j)*sin_m)
+    return (r*sin_phi*cos_theta, r*sin_phi*sin_theta, r*cos_phi,
+            phase(psi))
+
+
+@lru_cache(maxsize=32)
+def sampling_tables(n, l, m, s, z, fraction, samples):
+    '''
+    Return the tabulated cumulative distributions (x, cdf) of r, phi and
+    theta used by sample_points, computed once per orbital. theta is None
+    when it is uniformly distributed.
+    '''
+    l = hyd.l_numbers.get(l, l)
+    am, coefficient, part = hyd.angular_parts(l, m, s)
+    radial = hyd.get_radial(n, l, z)
+    r_max = hyd.get_radius(radial, fraction)
+    r = cumulative_table(lambda r: (r*radial(r))**2, 0, r_max, samples)
+    phi = cumulative_table(lambda phi: np.sin(phi)*hyd.associated_legendre(
+        l, am, np.cos(phi), np.sin(phi))**2, 0, np.pi, samples)
+    theta = None
+    if am and part == 'cos':
+        theta = cumulative_table(lambda theta: np.cos(am*theta)**2, 0,
+                                 2*np.pi, samples)
+    elif am and part == 'sin':
+        theta = cumulative_table(lambda theta: np.sin(am*theta)**2, 0,
+                                 2*np.pi, samples)
+    return r, phi, theta
+
+
+def slabs(orbital, grid, max_bytes=256 * 2**20):
+    '''
+    Evaluate an orbital over a Grids.CartesianGrid one slab of planes at a
+    time, yielding (planes, density, phase) where planes is the slice of
+    the first (x) axis covered by the slab, i.e. density fills
+    full_density[planes]. Slabs are sized so that about max_bytes are in
+    use at once, which lets grids too large to hold in memory be streamed
+    into histograms, point samplers or files.
+    '''
+    nx = grid.shape[0]
+    depth = slab_depth(grid, max_bytes)
+    for start in range(0, nx, depth):
+        planes = slice(start, min(start + depth, nx))
+        psi = orbital.evaluate(grid.slab(planes.start, planes.stop))
+        yield planes, density(psi), phase(psi)
+
+
+def slab_depth(grid, max_bytes):
+    '''The number of planes in a slab which keeps to max_bytes'''
+    nx, ny, nz = grid.shape
+    plane_bytes = ny * nz * grid.dtype.itemsize * slab_footprint
+    return int(max(1, min(nx, max_bytes // plane_bytes)))
+
+
+def parallel_evaluate(orbital, grid, density=False, workers=None,
+                      processes=False, max_bytes=64 * 2**20):
+    '''
+    Return orbital.evaluate(grid, density) for a Grids.CartesianGrid,
+    computed slab by slab on a pool of workers (os.cpu_count() by default).
+
+    NumPy releases the GIL in its ufuncs, so a thread pool usually scales.
+    With processes=True the slabs are computed in worker processes which
+    write straight into a shared memory output instead. Every point goes
+    through exactly the same operations as in orbital.evaluate, so the
+    result is identical bit for bit whatever the pool.
+    '''
+    workers = workers or os.cpu_count() or 1
+    nx = grid.shape[0]
+    # Give each worker a few slabs so that uneven slabs still balance
+    depth = min(slab_depth(grid, max_bytes), max(1, -(-nx // (4 * workers))))
+    starts = range(0, nx, depth)
+    stops = [min(start + depth, nx) for start in starts]
+    dtype = orbital.evaluate(grid.slab(0, 1), density).dtype
+    if processes:
+        return evaluate_processes(orbital, grid, density, workers, dtype,
+                                  starts, stops)
+    out = np.empty(grid.shape, dtype)
+
+    def evaluate(start, stop):
+        out[start:stop] = orbital.evaluate(grid.slab(start, stop), density)
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(evaluate, starts, stops))
+    return out
+
+
+def evaluate_processes(orbital, grid, density, workers, dtype, starts,
+                       stops):
+    '''The process pool half of parallel_evaluate'''
+    memory = shared_memory.SharedMemory(
+        create=True, size=max(1, int(np.prod(grid.shape)) * dtype.itemsize))
+    try:
+        numbers = (orbital.n, orbital.l, orbital.m, orbital.s, orbital.z)
+        # Spawned workers start from scratch, so hand them the kernels and
+        # precision selected here
+        with ProcessPoolExecutor(workers, initializer=start_worker,
+                                 initargs=(hyd.kernel_backend,
+                                           Grids.precision)) as pool:
+            list(pool.map(evaluate_into, repeat(memory.name),
+                          repeat(grid.shape), repeat(dtype.str),
+                          repeat(numbers), repeat(grid.axes),
+                          repeat(density), starts, stops))
+        return np.ndarray(grid.shape, dtype, memory.buf).copy()
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+def start_worker(backend, precision):
+    '''Process pool initializer: select the parent's kernels and precision'''
+    hyd.set_kernels(backend)
+    Grids.set_precision(precision)
+
+
+def evaluate_into(name, shape, dtype, numbers, axes, density, start, stop):
+    '''Process pool task: evaluate one slab into the shared output'''
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        out = np.ndarray(shape, dtype, memory.buf)
+        grid = Grids.CartesianGrid(dtype=axes[0].dtype, axes=axes)
+        orbital = hyd.get_orbital(*numbers)
+        out[start:stop] = orbital.evaluate(grid.slab(start, stop), density)
+        del out
+    finally:
+        memory.close()
+
+
+def save_slabs(orbital, grid, prefix, max_bytes=256 * 2**20):
+    '''
+    Stream the density and phase of an orbital on a Grids.CartesianGrid into
+    prefix_density.npy and prefix_phase.npy, and return them as memmaps
+    '''
+    density = np.lib.format.open_memmap(prefix + '_density.npy', 'w+',
+                                        grid.dtype, grid.shape)
+    phase = np.lib.format.open_memmap(prefix + '_phase.npy', 'w+',
+                                      grid.dtype, grid.shape)
+    for planes, slab_density, slab_phase in slabs(orbital, grid, max_bytes):
+        density[planes] = slab_density
+        phase[planes] = slab_phase
+    density.flush()
+    phase.flush()
+    return density, phase
+
+
+def precision_errors(dtype=np.float32, tolerance=1e-5, extent=20,
+                     resolution=48, names=None):
+    '''
+    Check that reduced precision is good enough for rendering by comparing
+    every orbital in Hydrogenic.orbitals (or just those named) evaluated on
+    a CartesianGrid of the given dtype against float64. Returns a list of
+    (name, density error, phase error) for the orbitals where either error
+    exceeds the tolerance, so an empty list means the dtype is safe. The
+    density error is relative to its peak, and the phase error (in radians)
+    is only measured where the density is above 1e-3 of its peak, away from
+    the nodes where the phase is undefined.
+    '''
+    low = Grids.CartesianGrid(extent, resolution, dtype)
+    high = Grids.CartesianGrid(extent, resolution, np.float64)
+    failures = []
+    for name in names or hyd.orbitals:
+        orbital = hyd.orbitals[name]
+        psi, reference = orbital.evaluate(low), orbital.evaluate(high)
+        density_low, density_high = density(psi), density(reference)
+        peak = density_high.max()
+        density_error = np.max(np.abs(density_low - density_high)) / peak
+        significant = density_high > 1e-3 * peak
+        difference = phase(psi)[significant] - phase(reference)[significant]
+        phase_error = np.max(np.abs(np.angle(np.exp(1j*difference))))
+        if not (density_error <= tolerance and phase_error <= tolerance):
+            failures.append((name, density_error, phase_error))
+    return failures
+
+
+def cumulative_table(pdf, low, high, samples=4096):
+    '''
+    Tabulate the cumulative distribution of pdf, which need not be
+    normalized, at the given number of samples on [low, high] and return
+    (x, cdf) with cdf running from 0 to 1
+    '''
+    x = np.linspace(low, high, samples)
+    density = pdf(x)
+    cdf = np.empty(samples)
+    cdf[0] = 0
+    np.cumsum(0.5*(density[1:] + density[:-1])*np.diff(x), out=cdf[1:])
+    cdf /= cdf[-1]
+    return x, cdf
+
+
+def draw(table, count, random):
+    '''
+    Draw count values distributed as a table from cumulative_table. The
+    uniform numbers are sorted first, so the interpolation walks through
+    the table in order rather than searching it afresh for each one, and
+    the values are then shuffled back into a random order.
+    '''
+    x, cdf = table
+    values = np.interp(np.sort(random.random(count)), cdf, x)
+    random.shuffle(values)
+    return values
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Matthew B. Rowley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.